@@ -0,0 +1,129 @@
+"""
+Hot queries, run straight on the pool's asyncpg connections with positional
+parameters. This skips the query compilation `databases` does on every call,
+and asyncpg keeps each statement prepared per connection (DB_STATEMENT_CACHE_SIZE),
+so repeated calls only send the parameters.
+"""
+from contextlib import asynccontextmanager
+
+from database import database
+from utils.metrics import span, db_duration
+
+
+USER = """
+    SELECT id, username, email, preference_text, preference_keywords
+    FROM "user"
+    WHERE id = $1
+"""
+
+USER_EMBEDDING = 'SELECT preference_embedding FROM "user" WHERE id = $1'
+
+REPORT_FOR_DAY = """
+    SELECT id, created_at, text, article_ids, date
+    FROM reports
+    WHERE user_id = $1 AND date >= $2 AND date < $3
+    ORDER BY created_at DESC
+    LIMIT 1
+"""
+
+REPORT_ARTICLES = """
+    SELECT articles.id, articles.url, articles.title, articles.date, articles.summary,
+        sources.id AS source_id, sources.name AS source_name, sources.url AS source_url, sources.favicon AS source_favicon
+    FROM articles
+    LEFT JOIN sources ON sources.id = articles.source_id
+    WHERE articles.id = ANY($1::INTEGER[])
+"""
+
+# Content is only needed to summarize articles that have no summary yet
+SELECTED_ARTICLES = """
+    SELECT id, url, title, date, summary, keyword,
+        CASE WHEN summary IS NULL THEN content END AS content
+    FROM articles
+    WHERE id = ANY($1::INTEGER[])
+"""
+
+PRECOMPUTED_CANDIDATES = """
+    SELECT articles.id, articles.title_embedding
+    FROM user_candidates
+    JOIN articles ON articles.id = user_candidates.article_id
+    WHERE user_candidates.user_id = $1 AND user_candidates.day = $2 AND articles.duplicate_of IS NULL
+    ORDER BY user_candidates.score DESC, articles.id
+    LIMIT $3
+"""
+
+EXISTING_URLS = "SELECT url FROM article_urls WHERE url = ANY($1::TEXT[])"
+
+CLUSTER_SELECTION = """
+    SELECT cluster_selections.article_ids
+    FROM user_clusters
+    JOIN cluster_selections ON cluster_selections.day = user_clusters.day AND cluster_selections.cluster = user_clusters.cluster
+    WHERE user_clusters.user_id = $1 AND user_clusters.day = $2
+"""
+
+
+@asynccontextmanager
+async def connection():
+    # Shares the connection of a surrounding `database.transaction()`
+    async with database.connection() as database_connection:
+        yield database_connection.raw_connection
+
+
+async def fetch(name: str, query: str, *args):
+    with span(name, db_duration, "operation"):
+        async with connection() as raw_connection:
+            return await raw_connection.fetch(query, *args)
+
+
+async def fetchrow(name: str, query: str, *args):
+    with span(name, db_duration, "operation"):
+        async with connection() as raw_connection:
+            return await raw_connection.fetchrow(query, *args)
+
+
+async def fetchval(name: str, query: str, *args):
+    with span(name, db_duration, "operation"):
+        async with connection() as raw_connection:
+            return await raw_connection.fetchval(query, *args)
+
+
+async def iterate(name: str, query: str, *args):
+    """Stream rows through a server-side cursor."""
+    with span(name, db_duration, "operation"):
+        async with connection() as raw_connection:
+            async with raw_connection.transaction():
+                async for row in raw_connection.cursor(query, *args):
+                    yield row
+
+
+async def get_user(user_id: int):
+    """The user's profile without the preference embedding."""
+    row = await fetchrow("user", USER, user_id)
+    return dict(row) if row else None
+
+
+async def get_user_embedding(user_id: int):
+    return await fetchval("user_embedding", USER_EMBEDDING, user_id)
+
+
+async def report_for_day(user_id: int, start_of_day, end_of_day):
+    return await fetchrow("report_for_day", REPORT_FOR_DAY, user_id, start_of_day, end_of_day)
+
+
+async def report_articles(article_ids: list):
+    return await fetch("report_articles", REPORT_ARTICLES, list(article_ids))
+
+
+async def selected_articles(article_ids: list):
+    return await fetch("selected_articles", SELECTED_ARTICLES, list(article_ids))
+
+
+def precomputed_candidates(user_id: int, day, limit: int):
+    return iterate("precomputed_candidates", PRECOMPUTED_CANDIDATES, user_id, day, limit)
+
+
+async def existing_urls(urls: list) -> set:
+    return {row['url'] for row in await fetch("existing_urls", EXISTING_URLS, list(urls))}
+
+
+async def cluster_selection(user_id: int, day):
+    return await fetchval("cluster_selection", CLUSTER_SELECTION, user_id, day)
@@ -1,11 +1,49 @@
 import os
 from databases import Database
 import bcrypt
+from utils.vectors import register_vector_codec
+from utils.metrics import span, db_duration
 
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
 EMBEDDINGS_SIZE = os.environ.get('EMBEDDINGS_SIZE', 1024)
-database = Database(DATABASE_URL)
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 2))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 20))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 256))
+# Idle connections above min_size are closed after this many seconds
+DB_MAX_INACTIVE_CONNECTION_LIFETIME = float(os.environ.get('DB_MAX_INACTIVE_CONNECTION_LIFETIME', 300))
+
+
+class InstrumentedDatabase(Database):
+    async def fetch_all(self, query, values=None):
+        with span("fetch_all", db_duration, "operation"):
+            return await super().fetch_all(query, values)
+
+    async def fetch_one(self, query, values=None):
+        with span("fetch_one", db_duration, "operation"):
+            return await super().fetch_one(query, values)
+
+    async def fetch_val(self, query, values=None, column=0):
+        with span("fetch_val", db_duration, "operation"):
+            return await super().fetch_val(query, values, column)
+
+    async def execute(self, query, values=None):
+        with span("execute", db_duration, "operation"):
+            return await super().execute(query, values)
+
+    async def execute_many(self, query, values):
+        with span("execute_many", db_duration, "operation"):
+            return await super().execute_many(query, values)
+
+
+database = InstrumentedDatabase(
+    DATABASE_URL,
+    init=register_vector_codec,
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+    max_inactive_connection_lifetime=DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+)
 
 
 async def create_tables(database: Database):
@@ -30,6 +68,7 @@ async def create_tables(database: Database):
         );
     """)
 
+    # Migration 10 turns this into a table range-partitioned by date
     await database.execute(f"""
         CREATE TABLE IF NOT EXISTS "articles" (
             id SERIAL PRIMARY KEY,
@@ -55,6 +94,15 @@ async def create_tables(database: Database):
         );
     """)
 
+    await database.execute(f"""
+        CREATE TABLE IF NOT EXISTS "embedding_cache" (
+            key CHAR(64) PRIMARY KEY,
+            model TEXT,
+            embedding vector({EMBEDDINGS_SIZE}),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
 
 async def seed_database(database: Database):
     password = "admin"
@@ -72,12 +120,15 @@ async def seed_database(database: Database):
 
 async def initialize_database(database: Database):
     await database.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+    # Connections opened before the extension existed have no vector codec
+    await database.disconnect()
+    await database.connect()
     await create_tables(database)
     await seed_database(database)
 
 
 async def tables_exist(database: Database) -> bool:
-    required_tables = {'user', 'sources', 'articles', 'reports'}
+    required_tables = {'user', 'sources', 'articles', 'reports', 'embedding_cache'}
     existing_tables = await database.fetch_all(
         "SELECT table_name FROM information_schema.tables WHERE table_schema = 'public';"
     )
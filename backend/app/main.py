@@ -2,42 +2,54 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import asyncio
-from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from contextlib import asynccontextmanager
 from routers import reports, preference
 from database import database, initialize_database, tables_exist
+from migrations import apply_migrations
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from utils.articles import fetch_and_insert_articles, generate_reports_for_past_week
-from routers.reports import user
-import httpx
-import os
-
-OPENAI_TTS_API_URL = "https://api.openai.com/v1/audio/speech"
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+from utils.articles import shutdown_executors
+from utils.scheduler import run_crawl, backfill
+from utils.partitions import run_retention
+from utils.embeddings import cache as embedding_cache
+from utils.downloads import downloader
+from utils.tts import audio_key, audio_store, audio_response, open_speech, stream_speech, close_client as close_tts_client
+from utils.metrics import registry
+from utils.llm_cache import llm_cache
+from utils.jobs import report_workers
+from utils.profiler import profiler, PROFILER_ENABLED
+import re
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await database.connect()
     if not await tables_exist(database):
         await initialize_database(database)
+    await apply_migrations(database)
+
+    stop_event = asyncio.Event()
 
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(lambda: fetch_and_insert_articles(user=Depends(user)), 'cron', hour='*/6')
+    scheduler.add_job(run_crawl, 'cron', hour='*/6', kwargs={"stop_event": stop_event}, max_instances=1, coalesce=True)
+    scheduler.add_job(run_retention, 'cron', hour=3, max_instances=1, coalesce=True)
     scheduler.start()
 
-    stop_event = asyncio.Event()
-    # articles_task = asyncio.create_task(fetch_and_insert_articles(await user(), stop_event))
-    reports_task = asyncio.create_task(generate_reports_for_past_week(await user(), stop_event))
+    backfill_task = asyncio.create_task(backfill(stop_event))
+    report_workers.start()
 
     yield
 
     stop_event.set()
-    # await articles_task
-    await reports_task
+    await report_workers.stop()
+    await backfill_task
 
     scheduler.shutdown()
+    profiler.stop()
+    shutdown_executors()
+    await downloader.close()
+    await close_tts_client()
     await database.disconnect()
 
 app = FastAPI(lifespan=lifespan)
@@ -54,6 +66,41 @@ app.add_middleware(
 app.include_router(reports.router)
 app.include_router(preference.router)
 
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.post("/debug/profiler")
+async def toggle_profiler(request: Request):
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404)
+    request_json = await request.json()
+    if request_json.get("enabled"):
+        profiler.start()
+    else:
+        profiler.stop()
+    if request_json.get("reset"):
+        profiler.reset()
+    return {"running": profiler.running}
+
+@app.get("/debug/profiler")
+async def get_profile():
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404)
+    return PlainTextResponse(profiler.collapsed())
+
+@app.get("/stats/embedding-cache")
+async def get_embedding_cache_stats():
+    return embedding_cache.stats()
+
+@app.get("/stats/llm-cache")
+async def get_llm_cache_stats():
+    return llm_cache.stats()
+
+@app.get("/stats/llm-savings")
+async def get_llm_savings(days: int = 7):
+    return await llm_cache.savings(days)
+
 @app.post("/generate-tts")
 async def generate_tts(request: Request):
     request_json = await request.json()
@@ -62,21 +109,18 @@ async def generate_tts(request: Request):
     if not text:
         raise HTTPException(status_code=400, detail="Text is required")
 
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json",
-    }
-
-    data = {
-        "model": "tts-1",
-        "input": text,
-        "voice": "fable",
-    }
-
-    async def stream_audio():
-        async with httpx.AsyncClient() as client:
-            async with client.stream("POST", OPENAI_TTS_API_URL, json=data, headers=headers) as response:
-                async for chunk in response.aiter_bytes():
-                    yield chunk
-
-    return StreamingResponse(stream_audio(), media_type="audio/mpeg")
+    key = audio_key(text)
+    path = await asyncio.to_thread(audio_store.get, key)
+    if path:
+        return await audio_response(request, path)
+
+    # Opened before responding, so upstream errors become an error status instead of truncated audio
+    response = await open_speech(text)
+    return StreamingResponse(stream_speech(response, key), media_type="audio/mpeg", headers={"X-Audio-Key": key})
+
+@app.get("/tts/{key}")
+async def get_tts(key: str, request: Request):
+    path = await asyncio.to_thread(audio_store.get, key) if re.fullmatch(r'[0-9a-f]{64}', key) else None
+    if not path:
+        raise HTTPException(status_code=404, detail="Audio not found")
+    return await audio_response(request, path)
@@ -0,0 +1,251 @@
+from databases import Database
+
+
+# Append-only: (version, name, statements). Never edit a migration that has shipped.
+MIGRATIONS = [
+    (1, "articles_date_index", [
+        "CREATE INDEX IF NOT EXISTS articles_date_idx ON articles (date);",
+    ]),
+    (2, "articles_title_embedding_hnsw_index", [
+        "CREATE INDEX IF NOT EXISTS articles_title_embedding_hnsw_idx ON articles USING hnsw (title_embedding vector_cosine_ops);",
+    ]),
+    (3, "reports_user_id_date_index", [
+        "CREATE INDEX IF NOT EXISTS reports_user_id_date_idx ON reports (user_id, date);",
+    ]),
+    (4, "scheduler_jobs", [
+        """
+        CREATE TABLE IF NOT EXISTS "scheduler_jobs" (
+            kind TEXT,
+            key TEXT,
+            status TEXT,
+            error TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, key)
+        );
+        """,
+    ]),
+    (5, "url_fetch_state", [
+        """
+        CREATE TABLE IF NOT EXISTS "url_fetch_state" (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            failures INTEGER DEFAULT 0,
+            retry_after TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+    ]),
+    (6, "articles_near_duplicates", [
+        "ALTER TABLE articles ADD COLUMN IF NOT EXISTS minhash BYTEA;",
+        "ALTER TABLE articles ADD COLUMN IF NOT EXISTS duplicate_of INTEGER REFERENCES articles(id) ON DELETE SET NULL;",
+        "CREATE INDEX IF NOT EXISTS articles_duplicate_of_idx ON articles (duplicate_of);",
+    ]),
+    (7, "llm_cache", [
+        """
+        CREATE TABLE IF NOT EXISTS "llm_cache" (
+            key CHAR(64) PRIMARY KEY,
+            kind TEXT,
+            model TEXT,
+            value TEXT,
+            size INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS llm_cache_last_used_at_idx ON llm_cache (last_used_at);",
+    ]),
+    (8, "user_candidates", [
+        """
+        CREATE TABLE IF NOT EXISTS "user_candidates" (
+            user_id INTEGER REFERENCES "user"(id) ON DELETE CASCADE,
+            day DATE,
+            article_id INTEGER REFERENCES articles(id) ON DELETE CASCADE,
+            score REAL,
+            PRIMARY KEY (user_id, day, article_id)
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS user_candidates_article_id_idx ON user_candidates (article_id);",
+        # Seed the last week from the articles already stored
+        """
+        INSERT INTO user_candidates (user_id, day, article_id, score)
+        SELECT "user".id, days.day, candidates.id, candidates.score
+        FROM "user"
+        CROSS JOIN (SELECT CAST(day AS DATE) AS day FROM generate_series(CURRENT_DATE - 6, CURRENT_DATE, INTERVAL '1 day') AS day) days
+        CROSS JOIN LATERAL (
+            SELECT id, 1 - (title_embedding <=> "user".preference_embedding) AS score
+            FROM (
+                -- Exact ranking of the day's rows, not the HNSW index with a post-filter
+                SELECT id, title_embedding
+                FROM articles
+                WHERE date >= days.day AND date < days.day + 1 AND duplicate_of IS NULL
+                OFFSET 0
+            ) day_articles
+            ORDER BY title_embedding <=> "user".preference_embedding
+            LIMIT 50
+        ) candidates
+        WHERE "user".preference_embedding IS NOT NULL
+        ON CONFLICT DO NOTHING;
+        """,
+    ]),
+    (9, "report_jobs", [
+        """
+        CREATE TABLE IF NOT EXISTS "report_jobs" (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES "user"(id) ON DELETE CASCADE,
+            date DATE,
+            status TEXT,
+            report_id INTEGER REFERENCES reports(id) ON DELETE SET NULL,
+            error TEXT,
+            attempts INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        );
+        """,
+        # At most one active job per report, duplicate requests coalesce onto it
+        "CREATE UNIQUE INDEX IF NOT EXISTS report_jobs_active_idx ON report_jobs (user_id, date) WHERE status IN ('queued', 'running');",
+        "CREATE INDEX IF NOT EXISTS report_jobs_queued_idx ON report_jobs (created_at, id) WHERE status = 'queued';",
+    ]),
+    # Weekly range partitions on date. Keys of a partitioned table must include the
+    # partition key, so ids are unique per (id, date), urls per (url, date), and
+    # nothing can reference articles(id) by foreign key any more.
+    (10, "articles_partitioned", [
+        """
+        DO $$
+        DECLARE
+            week TIMESTAMP;
+        BEGIN
+            IF (SELECT relkind FROM pg_class WHERE oid = 'articles'::regclass) = 'p' THEN
+                RETURN;
+            END IF;
+
+            ALTER TABLE articles RENAME TO articles_unpartitioned;
+            ALTER TABLE user_candidates DROP CONSTRAINT IF EXISTS user_candidates_article_id_fkey;
+
+            CREATE TABLE articles (LIKE articles_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (date);
+            ALTER TABLE articles ALTER COLUMN date SET NOT NULL;
+
+            FOR week IN SELECT DISTINCT date_trunc('week', date) FROM articles_unpartitioned WHERE date IS NOT NULL LOOP
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF articles FOR VALUES FROM (%L) TO (%L)',
+                    'articles_w' || to_char(week, 'YYYYMMDD'), week, week + INTERVAL '7 days'
+                );
+            END LOOP;
+
+            -- Articles without a date were never report candidates
+            INSERT INTO articles (id, url, title, date, summary, content, title_embedding, source_id, keyword, minhash, duplicate_of)
+            SELECT id, url, title, date, summary, content, title_embedding, source_id, keyword, minhash, duplicate_of
+            FROM articles_unpartitioned
+            WHERE date IS NOT NULL;
+
+            ALTER SEQUENCE articles_id_seq OWNED BY articles.id;
+            DROP TABLE articles_unpartitioned;
+
+            ALTER TABLE articles ADD PRIMARY KEY (id, date);
+            ALTER TABLE articles ADD UNIQUE (url, date);
+            ALTER TABLE articles ADD FOREIGN KEY (source_id) REFERENCES sources(id) ON DELETE SET NULL;
+            DELETE FROM user_candidates WHERE NOT EXISTS (SELECT 1 FROM articles WHERE articles.id = user_candidates.article_id);
+        END $$;
+        """,
+        "CREATE INDEX IF NOT EXISTS articles_date_idx ON articles (date);",
+        "CREATE INDEX IF NOT EXISTS articles_title_embedding_hnsw_idx ON articles USING hnsw (title_embedding vector_cosine_ops);",
+        "CREATE INDEX IF NOT EXISTS articles_duplicate_of_idx ON articles (duplicate_of);",
+    ]),
+    (11, "shared_digests", [
+        "ALTER TABLE llm_cache ADD COLUMN IF NOT EXISTS prompt_tokens INTEGER DEFAULT 0;",
+        "ALTER TABLE llm_cache ADD COLUMN IF NOT EXISTS completion_tokens INTEGER DEFAULT 0;",
+        """
+        CREATE TABLE IF NOT EXISTS "user_clusters" (
+            day DATE,
+            user_id INTEGER REFERENCES "user"(id) ON DELETE CASCADE,
+            cluster INTEGER,
+            PRIMARY KEY (day, user_id)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS "cluster_selections" (
+            day DATE,
+            cluster INTEGER,
+            members INTEGER,
+            article_ids INTEGER[],
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (day, cluster)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS "llm_savings" (
+            day DATE,
+            kind TEXT,
+            model TEXT,
+            calls INTEGER DEFAULT 0,
+            prompt_tokens BIGINT DEFAULT 0,
+            completion_tokens BIGINT DEFAULT 0,
+            PRIMARY KEY (day, kind, model)
+        );
+        """,
+    ]),
+    # Partitioned keys include the date, so urls are kept unique across partitions here
+    (12, "article_urls", [
+        """
+        CREATE TABLE IF NOT EXISTS "article_urls" (
+            url TEXT PRIMARY KEY,
+            date TIMESTAMP NOT NULL
+        );
+        """,
+        """
+        INSERT INTO article_urls (url, date)
+        SELECT DISTINCT ON (url) url, date FROM articles ORDER BY url, date
+        ON CONFLICT DO NOTHING;
+        """,
+    ]),
+    # Members that took their cluster's selection; summaries are only prepared ahead for those clusters
+    (13, "cluster_selection_matches", [
+        "ALTER TABLE cluster_selections ADD COLUMN IF NOT EXISTS matches INTEGER DEFAULT 0;",
+    ]),
+    # Candidates rank one day's rows from the date index; the HNSW index filtered
+    # by date only after its nearest neighbours and was only paid for on writes
+    (14, "drop_articles_title_embedding_hnsw_index", [
+        "DROP INDEX IF EXISTS articles_title_embedding_hnsw_idx;",
+    ]),
+    # Whether the member took the selection that day, so cluster_selections.matches counts each once
+    (15, "user_cluster_matched", [
+        "ALTER TABLE user_clusters ADD COLUMN IF NOT EXISTS matched BOOLEAN DEFAULT FALSE;",
+    ]),
+]
+
+# Arbitrary key so concurrent workers don't apply the same migration twice
+MIGRATIONS_LOCK_ID = 4242
+
+
+async def applied_migrations(database: Database) -> set:
+    rows = await database.fetch_all("SELECT version FROM schema_migrations;")
+    return {row['version'] for row in rows}
+
+
+async def apply_migrations(database: Database):
+    await database.execute("""
+        CREATE TABLE IF NOT EXISTS "schema_migrations" (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+    for version, name, statements in MIGRATIONS:
+        if version in await applied_migrations(database):
+            continue
+
+        async with database.transaction():
+            await database.execute("SELECT pg_advisory_xact_lock(:lock_id);", {"lock_id": MIGRATIONS_LOCK_ID})
+            if version in await applied_migrations(database):
+                continue
+
+            for statement in statements:
+                await database.execute(statement)
+            await database.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (:version, :name);",
+                {"version": version, "name": name}
+            )
+
+        print(f"Applied migration {version}: {name}")
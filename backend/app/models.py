@@ -16,7 +16,7 @@ class Article(BaseModel):
     title: str
     date: datetime
     summary: str
-    source: Source
+    source: Optional[Source] = None
 
 
 class ReportSection(BaseModel):
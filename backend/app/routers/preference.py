@@ -1,10 +1,8 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
 from database import database
 from routers.reports import user
-from utils.articles import embed_query
-from utils.ai import keyword_chain
+from utils.preferences import update_preference_in_background
 from models import Preference
-import json
 
 router = APIRouter()
 
@@ -14,27 +12,18 @@ async def get_preference(user: dict = Depends(user)):
     return user["preference_text"]
 
 
-@router.put("/preference")
-async def update_preference(preference: Preference, user: dict = Depends(user)):
+@router.put("/preference", status_code=status.HTTP_202_ACCEPTED)
+async def update_preference(preference: Preference, background_tasks: BackgroundTasks, user: dict = Depends(user)):
     text = preference.preference
-    embedding = embed_query(text)
 
-    # Generate keywords
-    keywords = keyword_chain.invoke({"preference_text": text})
-    keyword_list = [keyword.strip() for keyword in keywords.split('\n') if keyword.strip()]
-
-    # Update user preference and keywords in database
+    # Keywords, embedding, crawling and re-ranking follow in the background
     query = """
     UPDATE "user"
-    SET preference_text = :preference,
-        preference_embedding = :embedding,
-        preference_keywords = :keywords
+    SET preference_text = :preference
     WHERE id = :user_id
     """
     values = {
         "preference": text,
-        "embedding": json.dumps(embedding),
-        "keywords": keyword_list,  # Send as a list, not a JSON string
         "user_id": user["id"]
     }
 
@@ -43,4 +32,6 @@ async def update_preference(preference: Preference, user: dict = Depends(user)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
-    return {"message": "Preference updated successfully", "keywords": keyword_list}
+    background_tasks.add_task(update_preference_in_background, user["id"], text)
+
+    return {"message": "Preference update accepted"}
@@ -1,24 +1,49 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from datetime import date, datetime, timedelta
 from database import database
+from dal import get_user, get_user_embedding, report_for_day, report_articles
 from models import Report
-from utils.ai import generate_report
+from utils.ai import select_report_articles, detach
+from utils.jobs import enqueue_report, get_job, start_report_job, stream_job, finish_job
+from utils.report_cache import report_cache, respond
+import json
 from typing import List, Dict, Any
 
 router = APIRouter()
 
-async def user():
-    return await database.fetch_one("SELECT * FROM \"user\" WHERE id = :user_id", {"user_id": 1})
+async def user(request: Request):
+    # Looked up once per request, a preference update shows on the next one in every process
+    if not hasattr(request.state, "user"):
+        request.state.user = await get_user(1)
+    return request.state.user
 
 
-@router.post("/reports/today/create")
+def job_payload(job) -> dict:
+    return {key: job[key] for key in ("id", "date", "status", "report_id", "error", "created_at", "started_at", "finished_at")}
+
+
+@router.post("/reports/today/create", status_code=status.HTTP_202_ACCEPTED)
 async def create_report(user: dict = Depends(user)):
-    await generate_report(user)
+    return job_payload(await enqueue_report(user['id'], datetime.now().date()))
+
+
+@router.get("/reports/jobs/{job_id}")
+async def get_report_job(job_id: int, user: dict = Depends(user)):
+    job = await get_job(job_id, user['id'])
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job_payload(job)
 
 
 @router.get("/reports/dates")
-async def get_report_dates(user: dict = Depends(user)):
+async def get_report_dates(request: Request, user: dict = Depends(user)):
     user_id = user['id']
+    cached = report_cache.get_dates(user_id)
+    if cached:
+        return respond(request, cached)
+
     query = """
     SELECT DISTINCT DATE(date) as report_date
     FROM reports
@@ -26,11 +51,12 @@ async def get_report_dates(user: dict = Depends(user)):
     ORDER BY report_date DESC
     """
     rows = await database.fetch_all(query=query, values={"user_id": user_id})
-    return [row['report_date'].isoformat() for row in rows]
+    dates = [row['report_date'].isoformat() for row in rows]
+    return respond(request, report_cache.put_dates(user_id, dates))
 
 
 @router.get("/reports/{date}")
-async def get_report(date: str, user: dict = Depends(user)):
+async def get_report(date: str, request: Request, user: dict = Depends(user)):
     user_id = user['id']
     try:
         report_date = datetime.strptime(date, "%Y-%m-%d").date()
@@ -38,32 +64,22 @@ async def get_report(date: str, user: dict = Depends(user)):
         raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
 
     # First, fetch the report
-    report_query = """
-        SELECT id, created_at, text, article_ids, date
-        FROM reports
-        WHERE user_id = :user_id AND DATE(date) = :report_date
-        ORDER BY created_at DESC
-        LIMIT 1
-    """
-    report_values = {
-        "user_id": user_id,
-        "report_date": report_date
-    }
-    report_row = await database.fetch_one(query=report_query, values=report_values)
+    report_row = await report_for_day(
+        user_id,
+        datetime.combine(report_date, datetime.min.time()),
+        datetime.combine(report_date + timedelta(days=1), datetime.min.time())
+    )
 
     if not report_row:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No report found for the specified date")
 
+    # Reports can be regenerated by other processes, so the body is only reused for the latest id
+    cached = report_cache.get_report(user_id, report_date, report_row["id"])
+    if cached:
+        return respond(request, cached)
+
     # Then, fetch the articles
-    articles_query = """
-        SELECT id, url, title, date, summary
-        FROM articles
-        WHERE id = ANY(:article_ids)
-    """
-    articles_values = {
-        "article_ids": report_row["article_ids"]
-    }
-    article_rows = await database.fetch_all(query=articles_query, values=articles_values)
+    article_rows = await report_articles(report_row["article_ids"])
 
     # Create a dictionary mapping article ids to their data
     article_dict = {
@@ -72,7 +88,13 @@ async def get_report(date: str, user: dict = Depends(user)):
             "url": row["url"],
             "title": row["title"],
             "date": row["date"],
-            "summary": row["summary"]
+            "summary": row["summary"],
+            "source": {
+                "id": row["source_id"],
+                "name": row["source_name"],
+                "url": row["source_url"],
+                "favicon": row["source_favicon"]
+            } if row["source_id"] else None
         }
         for row in article_rows
     }
@@ -88,12 +110,46 @@ async def get_report(date: str, user: dict = Depends(user)):
         "date": report_row["date"]
     }
 
-    return report
+    return respond(request, report_cache.put_report(user_id, report_date, report))
+
 
+@router.post("/reports/{date}/create", status_code=status.HTTP_202_ACCEPTED)
+async def create_report_for_date(date: str, user: dict = Depends(user)):
+    try:
+        report_date = datetime.strptime(date, "%Y-%m-%d").date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+    return job_payload(await enqueue_report(user['id'], report_date))
 
 
-@router.post("/reports/{date}/create")
-async def create_report(date: str, user: dict = Depends(user)):
-    day_offset = (datetime.now().date() - datetime.strptime(date, "%Y-%m-%d").date()).days
-    print(day_offset)
-    await generate_report(user, day_offset)
+@router.post("/reports/{date}/stream")
+async def create_report_stream(date: str, user: dict = Depends(user)):
+    try:
+        report_date = datetime.strptime(date, "%Y-%m-%d").date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+
+    # Holds the job guard for (user, date), so a queued or running job never saves a second report
+    job = await start_report_job(user['id'], report_date)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A report for this date is already queued or running, POST /reports/{date}/create returns its job"
+        )
+
+    try:
+        # The request's user leaves out the embedding, only selection needs it
+        user = {**user, "preference_embedding": await get_user_embedding(user['id'])}
+        report_date, articles = await select_report_articles(user, (datetime.now().date() - report_date).days)
+    except HTTPException as e:
+        await finish_job(job['id'], "skipped", error=e.detail)
+        raise
+    except Exception as e:
+        await finish_job(job['id'], "failed", error=str(e))
+        raise
+
+    async def events():
+        async for event in detach(stream_job(job['id'], user, report_date, articles)):
+            yield json.dumps(jsonable_encoder(event)) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
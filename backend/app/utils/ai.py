@@ -1,23 +1,146 @@
-import json
+import asyncio
 import os
+import re
+import time
 from fastapi import HTTPException, status
 from datetime import datetime, timedelta
 
-import numpy as np
 from database import database
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough, RunnableLambda
-from operator import itemgetter
 
 from langchain_nvidia_ai_endpoints import ChatNVIDIA, NVIDIAEmbeddings
+from utils.mmr import mmr
+from utils.vectors import stream_vector_matrix
+from utils.context_parser import ContextStreamParser, parse_sections
+from utils.report_cache import report_cache
+from utils.tts import prerender_report
+from utils.metrics import span, record_llm_usage, registry, Counter
+from utils.llm_cache import llm_cache
+from utils.candidates import CANDIDATES_PER_DAY
+from dal import iterate, precomputed_candidates, selected_articles, cluster_selection
+
+
+def llm_usage(response) -> tuple:
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    prompt_tokens, completion_tokens = usage.get("prompt_tokens"), usage.get("completion_tokens")
+
+    if prompt_tokens is None:
+        # Streamed responses only report usage on the message
+        prompt_tokens = completion_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage_metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                prompt_tokens += usage_metadata.get("input_tokens", 0)
+                completion_tokens += usage_metadata.get("output_tokens", 0)
+
+    return prompt_tokens or 0, completion_tokens or 0
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    def __init__(self, model: str):
+        self.model = model
+
+    def on_llm_end(self, response, **kwargs):
+        record_llm_usage(self.model, *llm_usage(response))
+
+
+class TokenCounter(BaseCallbackHandler):
+    """Adds up the tokens of the calls made with it in their config, to store alongside cached outputs."""
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def on_llm_end(self, response, **kwargs):
+        prompt_tokens, completion_tokens = llm_usage(response)
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+
+    @property
+    def config(self) -> dict:
+        return {"callbacks": [self]}
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Deterministic stand-in for the chat models, for tests and benchmarks. Prompts
+    listing articles get a report with a context section per article, anything
+    else gets back the start of its content. Reports token usage like the real
+    models, counting words as tokens.
+    """
+
+    model: str = "fake"
+    latency: float = 0.0
+    token_latency: float = 0.0
+    summary_words: int = 60
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def respond(self, messages) -> str:
+        prompt = messages[-1].content
+        articles = re.findall(r"ID: (\d+)\nTitle: (.*)", prompt)
+        if articles:
+            overview = " ".join(f'<context id="{id}">{title}.</context>' for id, title in articles)
+            details = "\n\n".join(f'<context id="{id}">{title} was reported in detail.</context>' for id, title in articles)
+            return f"{overview}\n\n{details}"
+
+        content = re.search(r"Content: (.*)", prompt, re.DOTALL)
+        return " ".join((content.group(1) if content else prompt).split()[:self.summary_words])
+
+    def usage(self, messages, text: str) -> dict:
+        return {
+            "prompt_tokens": sum(len(str(message.content).split()) for message in messages),
+            "completion_tokens": len(text.split()),
+        }
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        text = self.respond(messages)
+        time.sleep(self.latency + self.token_latency * len(text.split()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))], llm_output={"token_usage": self.usage(messages, text)})
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        text = self.respond(messages)
+        await asyncio.sleep(self.latency + self.token_latency * len(text.split()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))], llm_output={"token_usage": self.usage(messages, text)})
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        text = self.respond(messages)
+        await asyncio.sleep(self.latency)
+        for token in re.findall(r"\s*\S+", text):
+            await asyncio.sleep(self.token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+        usage = self.usage(messages, text)
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata={
+            "input_tokens": usage["prompt_tokens"],
+            "output_tokens": usage["completion_tokens"],
+            "total_tokens": usage["prompt_tokens"] + usage["completion_tokens"],
+        }))
 
 
 def get_chat_model(env_name: str, default: str):
     name = os.environ.get(env_name, default)
+    if name.startswith('fake'):
+        return FakeChatModel(
+            model=name,
+            latency=float(os.environ.get("FAKE_LLM_LATENCY", 0)),
+            token_latency=float(os.environ.get("FAKE_LLM_TOKEN_LATENCY", 0)),
+            callbacks=[UsageCallbackHandler(name)],
+        )
     Model = ChatOpenAI if name.startswith('gpt') else ChatNVIDIA
-    return Model(model=name, temperature=0)
+    options = {"stream_usage": True} if Model is ChatOpenAI else {}
+    return Model(model=name, temperature=0, callbacks=[UsageCallbackHandler(name)], **options)
 
 
 summarization_model = get_chat_model('SUMMARIZATION_MODEL', 'gpt-3.5-turbo')
@@ -27,6 +150,21 @@ embeddings_model_name = os.environ.get("EMBEDDINGS_MODEL", "text-embedding-3-lar
 # embeddings_model = NVIDIAEmbeddings(model=embeddings_model_name, dimensions=int(os.environ.get("EMBEDDINGS_SIZE", 1024)))
 embeddings_model = OpenAIEmbeddings(model=embeddings_model_name, dimensions=int(os.environ.get("EMBEDDINGS_SIZE", 1024)))
 
+# Bump when a prompt changes, so cached outputs of the old prompt are no longer used
+SUMMARIZE_PROMPT_VERSION = 1
+REPORT_PROMPT_VERSION = 1
+
+SUMMARIZATION_CONCURRENCY = int(os.environ.get("SUMMARIZATION_CONCURRENCY", 4))
+REPORT_MAX_ARTICLES = int(os.environ.get("REPORT_MAX_ARTICLES", 8))
+# Off until bench_end_to_end.py --scenarios digests shows savings for the user base
+SHARED_DIGESTS = os.environ.get("SHARED_DIGESTS", "false").lower() == "true"
+# Share of a user's selection that has to agree with their cluster's to take the cluster's instead.
+# Users select from their own candidates and the cluster from all members', so identical
+# selections are rare; lower values trade personalisation for shared reports.
+CLUSTER_MATCH_MIN_OVERLAP = float(os.environ.get("CLUSTER_MATCH_MIN_OVERLAP", 0.75))
+
+cluster_matches = registry.register(Counter("news_cluster_selection_matches_total", "Report selections compared with the user's cluster", ("match",)))
+
 
 report_prompt = ChatPromptTemplate.from_messages([
     ("system", """
@@ -66,6 +204,11 @@ summarize_prompt = ChatPromptTemplate.from_messages([
 
 parser = StrOutputParser()
 
+
+def model_name(model) -> str:
+    return getattr(model, "model_name", None) or getattr(model, "model", "")
+
+
 summarize_chain = summarize_prompt | summarization_model | parser
 
 report_chain = report_prompt | report_model | parser
@@ -76,63 +219,87 @@ def format_articles(articles):
         for index, article in enumerate(articles)
     ])
 
-def selective_summarize(article):
+
+_summarization_semaphore = asyncio.Semaphore(SUMMARIZATION_CONCURRENCY)
+_summaries_in_flight = {}
+
+
+async def _summarize_and_store(article: dict):
+    inputs = {"title": article['title'], "content": article['content']}
+    # Near-identical copies of a story under different URLs share a summary
+    summary = await llm_cache.get("summarize", model_name(summarization_model), SUMMARIZE_PROMPT_VERSION, inputs)
+    if summary is None:
+        tokens = TokenCounter()
+        async with _summarization_semaphore, span("summarize"):
+            summary = await summarize_chain.ainvoke(inputs, config=tokens.config)
+        await llm_cache.put(
+            "summarize", model_name(summarization_model), SUMMARIZE_PROMPT_VERSION, inputs, summary,
+            tokens.prompt_tokens, tokens.completion_tokens
+        )
+
+    # Store right away so the summary survives a failure later in the report
+    await database.execute("UPDATE articles SET summary = :summary WHERE id = :id", {"summary": summary, "id": article['id']})
+    return summary
+
+
+async def summarize_article(article: dict):
     if article['summary']:
         return article
-    else:
-        summary = summarize_chain.invoke({"title": article['title'], "content": article['content']})
-        return {**article, "summary": summary}
 
-main_chain = (
-    RunnablePassthrough.assign(
-        articles_summarized=itemgetter("articles") | RunnablePassthrough.map(RunnableLambda(selective_summarize))
-    )
-    | RunnablePassthrough.assign(
-        date_formatted=lambda x: x["date"].strftime("%Y-%m-%d"),
-        articles_formatted=lambda x: format_articles(x["articles_summarized"])
-    )
-    | RunnablePassthrough.assign(
-        report=report_chain
-    )
-)
+    # Concurrent reports selecting the same article share one summarization call
+    task = _summaries_in_flight.get(article['id'])
+    if task is None:
+        task = asyncio.ensure_future(_summarize_and_store(article))
+        _summaries_in_flight[article['id']] = task
+        task.add_done_callback(lambda _: _summaries_in_flight.pop(article['id'], None))
 
-keyword_chain = keyword_prompt | report_model | parser
+    return {**article, "summary": await asyncio.shield(task)}
 
 
-def cosine_similarity(a, b):
-    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+async def summarize_articles(articles: list):
+    return list(await asyncio.gather(*(summarize_article(dict(article)) for article in articles)))
 
 
-def mmr(candidate_embeddings, candidate_ids, query_embedding, lambda_param, k):
-    unselected = set(candidate_ids)
-    selected = []
+def report_inputs(date, articles_summarized: list):
+    return {
+        "date_formatted": date.strftime("%Y-%m-%d"),
+        "articles_formatted": format_articles(articles_summarized)
+    }
 
-    while len(selected) < k and unselected:
-        relevance_scores = {
-            doc_id: cosine_similarity(query_embedding, candidate_embeddings[candidate_ids.index(doc_id)])
-            for doc_id in unselected
-        }
 
-        if not selected:
-            best_doc = max(relevance_scores.items(), key=lambda x: x[1])[0]
-        else:
-            def mmr_score(doc_id):
-                relevance = relevance_scores[doc_id]
-                diversity = min(
-                    1 - cosine_similarity(
-                        candidate_embeddings[candidate_ids.index(doc_id)],
-                        candidate_embeddings[candidate_ids.index(selected_id)]
-                    )
-                    for selected_id in selected
-                )
-                return lambda_param * relevance + (1 - lambda_param) * diversity
+def report_cache_inputs(date, articles_summarized: list):
+    # The summaries are fixed once stored, so the ordered ids stand in for the prompt
+    return {"date": date.strftime("%Y-%m-%d"), "article_ids": [article['id'] for article in articles_summarized]}
 
-            best_doc = max(unselected, key=mmr_score)
 
-        selected.append(best_doc)
-        unselected.remove(best_doc)
+async def cached_report(date, articles_summarized: list):
+    return await llm_cache.get("report", model_name(report_model), REPORT_PROMPT_VERSION, report_cache_inputs(date, articles_summarized))
 
-    return selected
+
+async def cache_report(date, articles_summarized: list, report: str, tokens: TokenCounter):
+    await llm_cache.put(
+        "report", model_name(report_model), REPORT_PROMPT_VERSION, report_cache_inputs(date, articles_summarized), report,
+        tokens.prompt_tokens, tokens.completion_tokens
+    )
+
+keyword_chain = keyword_prompt | report_model | parser
+
+
+# Cosine distance matches the MMR scoring
+DISTANCE_OPERATORS = {"cosine": "<=>", "l2": "<->"}
+VECTOR_DISTANCE = os.environ.get("VECTOR_DISTANCE", "cosine")
+CANDIDATE_LIMIT = int(os.environ.get("CANDIDATE_LIMIT", 1000))
+
+
+def candidate_query():
+    # $1, $2: start and end of the day, $3: preference embedding, $4: limit
+    return f"""
+        SELECT id, title_embedding
+        FROM articles
+        WHERE date >= $1 AND date < $2 AND duplicate_of IS NULL
+        ORDER BY title_embedding {DISTANCE_OPERATORS[VECTOR_DISTANCE]} $3
+        LIMIT $4
+    """
 
 
 async def get_todays_articles(user, day_offset=0, max_articles=5, lambda_param=0.8):
@@ -140,46 +307,93 @@ async def get_todays_articles(user, day_offset=0, max_articles=5, lambda_param=0
     start_of_day = datetime.combine(target_date, datetime.min.time())
     end_of_day = datetime.combine(target_date, datetime.max.time())
 
-    query = """
-        SELECT id, url, title, date, summary, content, title_embedding, keyword
-        FROM articles
-        WHERE date >= :start_of_day AND date < :end_of_day
-        ORDER BY title_embedding <-> :preference_embedding
-        LIMIT 1000
-    """
-    articles = await database.fetch_all(query, {
-        "start_of_day": start_of_day,
-        "end_of_day": end_of_day,
-        "preference_embedding": user['preference_embedding']
-    })
+    # Candidates are scored at ingest time; days without any fall back to ranking in the database.
+    # Only ids and embeddings are streamed for selection, through a server-side cursor.
+    with span("candidate_query"):
+        candidate_ids, candidate_embeddings = await stream_vector_matrix(precomputed_candidates(user['id'], target_date, CANDIDATES_PER_DAY), 'title_embedding', CANDIDATES_PER_DAY)
+        if not candidate_ids:
+            candidate_ids, candidate_embeddings = await stream_vector_matrix(iterate(
+                "candidate_search", candidate_query(), start_of_day, end_of_day, user['preference_embedding'], CANDIDATE_LIMIT
+            ), 'title_embedding', CANDIDATE_LIMIT)
 
-    if not articles:
+    if not candidate_ids:
         return []
 
-    candidate_embeddings = [np.array(json.loads(article['title_embedding']), dtype=np.float32) for article in articles]
-    candidate_ids = [article['id'] for article in articles]
-    query_embedding = np.array(json.loads(user['preference_embedding']), dtype=np.float32)
+    with span("mmr"):
+        selected_ids = mmr(candidate_embeddings, candidate_ids, user['preference_embedding'], lambda_param, max_articles)
 
-    selected_ids = mmr(candidate_embeddings, candidate_ids, query_embedding, lambda_param, max_articles)
+    return await fetch_selected_articles(selected_ids)
 
-    selected_articles = [next(article for article in articles if article['id'] == id) for id in selected_ids]
 
-    return selected_articles
+async def fetch_selected_articles(article_ids: list):
+    rows = await selected_articles(article_ids)
+    articles = {row['id']: row for row in rows}
+    return [articles[article_id] for article_id in article_ids if article_id in articles]
 
 
-async def generate_report(user: dict, day_offset: int = 0):
+async def align_with_cluster(user: dict, date, articles: list) -> tuple:
+    """
+    Takes the shared selection of the user's cluster (see utils/clusters.py) when
+    the user's own overlaps it by CLUSTER_MATCH_MIN_OVERLAP, in the cluster's
+    order, so the report is looked up under the same cache key for every member.
+    Returns the articles and the match: None without shared digests or a
+    cluster selection, otherwise "none", "partial" or "exact".
+    """
+    # Selections left from before SHARED_DIGESTS was turned off don't override the user's
+    if not SHARED_DIGESTS:
+        return articles, None
+
+    cluster_ids = await cluster_selection(user['id'], date)
+    if not cluster_ids or not articles:
+        return articles, None
+
+    selected_ids = [article['id'] for article in articles]
+    overlap = len(set(selected_ids) & set(cluster_ids)) / max(len(selected_ids), len(cluster_ids))
+    if overlap < CLUSTER_MATCH_MIN_OVERLAP:
+        return articles, "none"
+
+    if overlap == 1:
+        articles = {article['id']: article for article in articles}
+        return [articles[article_id] for article_id in cluster_ids], "exact"
+
+    return await fetch_selected_articles(cluster_ids), "partial"
+
+
+async def record_cluster_match(user_id: int, date):
+    # Counts each member once a day, regenerations and retried jobs don't add to it
+    await database.execute("""
+        WITH first_match AS (
+            UPDATE user_clusters SET matched = TRUE
+            WHERE user_id = :user_id AND day = :day AND NOT matched
+            RETURNING day, cluster
+        )
+        UPDATE cluster_selections SET matches = matches + 1
+        FROM first_match
+        WHERE cluster_selections.day = first_match.day AND cluster_selections.cluster = first_match.cluster
+    """, {"user_id": user_id, "day": date})
+
+
+async def select_report_articles(user: dict, day_offset: int = 0):
     date = datetime.now().date() - timedelta(days=day_offset)
-    articles = await get_todays_articles(user, day_offset=day_offset, max_articles=8)
+    articles = await get_todays_articles(user, day_offset=day_offset, max_articles=REPORT_MAX_ARTICLES)
+    articles, match = await align_with_cluster(user, date, articles)
+    if match:
+        cluster_matches.inc(match=match)
+    if match in ("partial", "exact"):
+        await record_cluster_match(user['id'], date)
     if not articles:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
-    result = main_chain.invoke({ 'date': date, 'articles': [dict(article) for article in articles] })
+    return date, articles
+
 
-    articles_summarized = result["articles_summarized"]
-    articles_to_update = [articles_summarized[i] for i in range(len(articles)) if not articles[i]['summary']]
-    await database.execute_many("UPDATE articles SET summary = :summary WHERE id = :id", [{'summary': article['summary'], 'id': article['id']} for article in articles_to_update])
+@span("prepare_report")
+async def prepare_report(user: dict, day_offset: int = 0):
+    date, articles = await select_report_articles(user, day_offset)
+    return date, await summarize_articles(articles)
 
-    report = result["report"]
+
+async def save_report(user: dict, date, articles: list, report: str):
     query = """
         INSERT INTO reports (user_id, created_at, text, article_ids, date)
         VALUES (:user_id, :created_at, :text, :article_ids, :date)
@@ -193,29 +407,97 @@ async def generate_report(user: dict, day_offset: int = 0):
         "date": date
     }
     report_id = await database.execute(query, values)
-
+    report_cache.invalidate(user['id'], date)
+    prerender_report(report)
     return report_id
 
 
-async def parse_generated_report(report_text: str):
-    import re
+async def generate_report(user: dict, day_offset: int = 0):
+    date, articles = await prepare_report(user, day_offset)
+    report = await cached_report(date, articles)
+    if report is None:
+        tokens = TokenCounter()
+        with span("report"):
+            report = await report_chain.ainvoke(report_inputs(date, articles), config=tokens.config)
+        await cache_report(date, articles, report, tokens)
+    return await save_report(user, date, articles, report)
+
 
-    sections = []
-    context_pattern = re.compile(r'<context id="(\d+)">(.*?)</context>', re.DOTALL)
-    contexts = context_pattern.findall(report_text)
+def article_payload(article: dict):
+    return {key: article[key] for key in ("id", "url", "title", "date", "summary")}
 
-    for i, (article_id, content) in enumerate(contexts):
-        sections.append({
-            "id": i + 1,
-            "content": content,
-            "article_id": int(article_id)
-        })
 
+async def stream_report(user: dict, date, articles: list):
+    """
+    Streams the report for selected articles as events: the articles right away,
+    each section as soon as its context tag closes, then `done` once the report
+    is persisted. Articles are summarized after the first event, so the list
+    shows before the summaries are ready.
+    """
+    yield {"type": "articles", "articles": [article_payload(article) for article in articles]}
+    articles = await summarize_articles(articles)
+
+    parser = ContextStreamParser()
+    report = await cached_report(date, articles)
+    tokens = TokenCounter()
+
+    async def chunks():
+        if report is not None:
+            yield report
+            return
+        with span("report_stream"):
+            async for chunk in report_chain.astream(report_inputs(date, articles), config=tokens.config):
+                yield chunk
+
+    received = []
+    async for chunk in chunks():
+        received.append(chunk)
+        for section in parser.feed(chunk):
+            index = section["article_id"]
+            article = article_payload(articles[index]) if 0 <= index < len(articles) else None
+            yield {"type": "section", **section, "article": article}
+
+    if report is None:
+        await cache_report(date, articles, "".join(received), tokens)
+    report_id = await save_report(user, date, articles, "".join(received))
+    yield {"type": "done", "report_id": report_id}
+
+
+_detached_streams = set()
+
+
+async def detach(events):
+    """
+    Runs an event stream to the end in a task of its own and yields its events.
+    A client that disconnects only stops reading, so a report whose tokens were
+    already paid for is still cached and saved.
+    """
+    queue = asyncio.Queue()
+
+    async def run():
+        async for event in events:
+            queue.put_nowait(event)
+
+    task = asyncio.create_task(run())
+    _detached_streams.add(task)
+    task.add_done_callback(_detached_streams.discard)
+    task.add_done_callback(lambda _: queue.put_nowait(None))
+
+    while (event := await queue.get()) is not None:
+        yield event
+    # Raises what failed the stream
+    await task
+
+
+async def presummarize(user: dict, day_offsets: tuple = (0,), max_articles: int = REPORT_MAX_ARTICLES):
+    # Summarize the articles a report would select now, so generating it later only pays for the report call
+    for day_offset in day_offsets:
+        articles = await get_todays_articles(user, day_offset=day_offset, max_articles=max_articles)
+        await summarize_articles(articles)
+
+
+async def parse_generated_report(report_text: str):
     return {
         "created_at": datetime.now(),
-        "sections": sections
+        "sections": parse_sections(report_text)
     }
-
-
-def embed_query(query: str):
-    return embeddings_model.embed_query(query)
@@ -1,36 +1,72 @@
 import newspaper
-from newspaper.google_news import GoogleNewsSource
-from database import database
 import asyncio
-from utils.ai import embed_query
-import json
-from datetime import datetime, timedelta
-from utils.ai import generate_report
-
-
-def get_article_urls(keywords: list, period: str = "1d", max_results=50, start_date: datetime = None, end_date: datetime = None):
-    if start_date and end_date:
-        source = GoogleNewsSource(country="US", period=period, max_results=max_results, start_date=start_date, end_date=end_date)
-    else:
-        source = GoogleNewsSource(country="US", period=period, max_results=max_results)
+import multiprocessing
+import os
+from urllib.parse import urljoin, urlsplit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dal import existing_urls
+from utils.bulk import ArticleWriter
+from utils.candidates import score_articles
+from utils.downloads import downloader
+from utils.dedup import minhash, get_index as get_dedup_index
+from utils.embeddings import embed, BATCH_SIZE as EMBEDDINGS_BATCH_SIZE
+from utils.partitions import oldest_kept_date
+from utils.pipeline import Stage, run_pipeline
+from utils.search import keyword_search
+from datetime import datetime
+
+
+FETCH_CONCURRENCY = int(os.environ.get("INGEST_FETCH_CONCURRENCY", 16))
+PARSE_CONCURRENCY = int(os.environ.get("INGEST_PARSE_CONCURRENCY", os.cpu_count() or 1))
+PARSE_EXECUTOR = os.environ.get("INGEST_PARSE_EXECUTOR", "process")
+# Enough concurrent embed workers to fill a batch
+EMBED_CONCURRENCY = int(os.environ.get("INGEST_EMBED_CONCURRENCY", EMBEDDINGS_BATCH_SIZE))
+QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", 64))
+
+_parse_executor = None
+
+
+def get_parse_executor():
+    global _parse_executor
+    if _parse_executor is None:
+        if PARSE_EXECUTOR == "thread":
+            _parse_executor = ThreadPoolExecutor(max_workers=PARSE_CONCURRENCY, thread_name_prefix="ingest-parse")
+        else:
+            # Forking the threaded server would copy locks other threads hold, forkserver starts clean
+            _parse_executor = ProcessPoolExecutor(max_workers=PARSE_CONCURRENCY, mp_context=multiprocessing.get_context("forkserver"))
+    return _parse_executor
+
+
+def shutdown_executors():
+    global _parse_executor
+    if _parse_executor is not None:
+        _parse_executor.shutdown(wait=False, cancel_futures=True)
+    _parse_executor = None
+
+
+async def get_article_urls(keywords: list, period: str = "1d", max_results=50, start_date: datetime = None, end_date: datetime = None):
+    results = await asyncio.gather(*(
+        keyword_search.search(keyword, period=period, max_results=max_results, start_date=start_date, end_date=end_date)
+        for keyword in keywords
+    ), return_exceptions=True)
 
     article_urls = []
+    searched = set()
 
-    for keyword in keywords:
-        source.build(top_news=False, keyword=keyword)
-        urls = source.article_urls()
+    for keyword, urls in zip(keywords, results):
+        if isinstance(urls, Exception):
+            print(f"Search for {keyword} failed: {urls}")
+            continue
+        searched.add(keyword)
         article_urls.extend([(url, keyword) for url in urls])
 
-    return article_urls
+    return article_urls, searched
 
 
-def get_article(url: str):
+def get_article(url: str, html: str):
     try:
-        user_agent = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36"
-        config = newspaper.Config()
-        config.browser_user_agent = user_agent
-        article = newspaper.Article(url, config=config)
-        article.download()
+        article = newspaper.Article(url)
+        article.download(input_html=html)
         article.parse()
     except Exception as e:
         # print(e)
@@ -40,59 +76,101 @@ def get_article(url: str):
 
 
 def shape_article(article: newspaper.Article, keyword: str):
+    source_url = article.source_url or "{0.scheme}://{0.netloc}".format(urlsplit(article.url))
     return {
         "url": article.url,
         "title": article.title,
         "date": article.publish_date.replace(tzinfo=None) if article.publish_date else None,
         "content": article.text,
-        "keyword": keyword
+        "keyword": keyword,
+        "source_name": article.meta_site_name or urlsplit(source_url).netloc.removeprefix("www."),
+        "source_url": source_url,
+        "source_favicon": urljoin(article.url, article.meta_favicon) if article.meta_favicon else None
     }
 
 
-async def fetch_and_insert_articles(user: dict, max_results=50, start_date: datetime = None, end_date: datetime = None, stop_event: asyncio.Event = None):
-    keywords = user["preference_keywords"] or []
-    article_urls = get_article_urls(keywords, max_results=max_results, start_date=start_date, end_date=end_date)
-
-    existing_urls = await database.fetch_all(
-        "SELECT url FROM articles WHERE url = ANY(:urls)",
-        {"urls": [url for url, _ in article_urls]}
-    )
-    existing_urls_set = {row['url'] for row in existing_urls}
-    new_article_urls = [(url, keyword) for url, keyword in article_urls if url not in existing_urls_set]
-
-    print(f"Found {len(new_article_urls)} articles for user {user['id']}")
-
-    for url, keyword in new_article_urls:
-        if stop_event and stop_event.is_set():
-            return
-
-        article = get_article(url)
-
-        if article:
-            shaped_article = shape_article(article, keyword)
-            if not (shaped_article["date"] and shaped_article["content"]): continue
-            title_embedding = embed_query(shaped_article["title"]) # TODO: Batch
-            values = shaped_article | { "title_embedding": json.dumps(title_embedding) }
-
-            await database.execute("""
-                INSERT INTO articles (url, title, date, content, title_embedding, keyword)
-                VALUES (:url, :title, :date, :content, :title_embedding, :keyword)
-                ON CONFLICT DO NOTHING;
-            """, values)
-
-
-async def generate_reports_for_past_week(user: dict, stop_event: asyncio.Event = None):
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=7)
-
-    await fetch_and_insert_articles(user, max_results=20, start_date=start_date, end_date=end_date, stop_event=stop_event)
-
-    for i in range(7):
-        if stop_event and stop_event.is_set():
-            return
-
-        report_date = end_date - timedelta(days=i)
-        report_exists = await database.fetch_one("SELECT id FROM reports WHERE user_id = :user_id AND DATE(date) = :report_date", {"user_id": user["id"], "report_date": report_date})
+def parse_article(url: str, html: str, keyword: str):
+    # Runs in the parse executor, so it only takes and returns picklable values
+    article = get_article(url, html)
+    if not article:
+        return None
+    shaped_article = shape_article(article, keyword)
+    return shaped_article | { "minhash": minhash(shaped_article["content"] or "") }
+
+
+async def fetch_and_insert_articles(keywords: list, max_results=50, start_date: datetime = None, end_date: datetime = None, stop_event: asyncio.Event = None):
+    """Crawls the keywords and returns the ones whose search succeeded."""
+    article_urls, searched = await get_article_urls(keywords, max_results=max_results, start_date=start_date, end_date=end_date)
+
+    existing_urls_set = await existing_urls([url for url, _ in article_urls])
+    fetch_states = await downloader.load_states([url for url, _ in article_urls if url not in existing_urls_set])
+    new_article_urls = []
+    for url, keyword in article_urls:
+        if url not in existing_urls_set and downloader.should_fetch(fetch_states.get(url)):
+            existing_urls_set.add(url)
+            new_article_urls.append((url, keyword))
+
+    print(f"Found {len(new_article_urls)} articles for {len(keywords)} keywords")
+
+    loop = asyncio.get_running_loop()
+    oldest_date = oldest_kept_date()
+
+    async def fetch(item):
+        url, keyword = item
+        html = await downloader.fetch(url, fetch_states)
+        return (url, html, keyword) if html else None
+
+    async def parse(item):
+        shaped_article = await loop.run_in_executor(get_parse_executor(), parse_article, *item)
+        if not (shaped_article and shaped_article["date"] and shaped_article["content"]):
+            downloader.record_failure(item[0], fetch_states)
+            return None
+        # Older than the retention window, it would only land in a partition due for removal
+        if shaped_article["date"] < oldest_date:
+            return None
+        return shaped_article
+
+    async def embed_title(shaped_article):
+        title_embedding = await embed(shaped_article["title"])
+        return shaped_article | { "title_embedding": title_embedding }
+
+    dedup_index = await get_dedup_index()
+    duplicates = 0
+
+    # Canonical articles become report candidates, keep what scoring them needs
+    canonical = {}
+
+    async def dedup(shaped_article):
+        nonlocal duplicates
+        canonical_url = dedup_index.find_duplicate(shaped_article["minhash"], shaped_article["title_embedding"], shaped_article["date"])
+        if canonical_url:
+            duplicates += 1
+        else:
+            dedup_index.add(shaped_article["url"], shaped_article["minhash"], shaped_article["title_embedding"], shaped_article["date"])
+            canonical[shaped_article["url"]] = {"date": shaped_article["date"], "title_embedding": shaped_article["title_embedding"]}
+        return shaped_article | { "canonical_url": canonical_url }
+
+    # Duplicates are linked to the article they repeat and are not report candidates themselves
+    writer = ArticleWriter()
+
+    await run_pipeline(new_article_urls, [
+        Stage("fetch", fetch, FETCH_CONCURRENCY),
+        Stage("parse", parse, PARSE_CONCURRENCY),
+        Stage("embed", embed_title, EMBED_CONCURRENCY),
+        # A single worker, so two copies of a story in one crawl can't miss each other
+        Stage("dedup", dedup, 1),
+        Stage("persist", writer.add, 1),
+    ], queue_size=QUEUE_SIZE, stop_event=stop_event)
+
+    await writer.flush()
+    await downloader.flush_states(fetch_states)
+    await score_articles([
+        {"id": row["id"], **canonical[row["url"]]}
+        for row in writer.inserted
+        if row["url"] in canonical
+    ])
+
+    print(f"Inserted {len(writer.inserted)} articles, {duplicates} of them near-duplicates")
+
+    return searched
 
-        if not report_exists:
-            await generate_report(user, day_offset=i)
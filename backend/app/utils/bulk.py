@@ -0,0 +1,114 @@
+import asyncio
+import os
+
+from database import database
+from utils.partitions import ensure_partitions
+
+
+BULK_FLUSH_SIZE = int(os.environ.get("BULK_FLUSH_SIZE", 500))
+
+STAGING_COLUMNS = [
+    "url", "title", "date", "content", "title_embedding", "keyword", "minhash",
+    "canonical_url", "source_name", "source_url", "source_favicon",
+]
+
+CREATE_STAGING = """
+    CREATE TEMP TABLE IF NOT EXISTS articles_staging (
+        url TEXT,
+        title TEXT,
+        date TIMESTAMP,
+        content TEXT,
+        title_embedding vector,
+        keyword TEXT,
+        minhash BYTEA,
+        canonical_url TEXT,
+        source_name TEXT,
+        source_url TEXT,
+        source_favicon TEXT
+    ) ON COMMIT DELETE ROWS;
+"""
+
+MERGE_STAGING = """
+    WITH upserted_sources AS (
+        -- sources.name is VARCHAR(255), site names are not bounded
+        INSERT INTO sources (name, url, favicon)
+        SELECT DISTINCT ON (LEFT(source_name, 255)) LEFT(source_name, 255), source_url, source_favicon
+        FROM articles_staging
+        WHERE source_name IS NOT NULL
+        ORDER BY LEFT(source_name, 255)
+        ON CONFLICT (name) DO UPDATE
+        SET url = COALESCE(sources.url, EXCLUDED.url),
+            favicon = COALESCE(EXCLUDED.favicon, sources.favicon)
+        RETURNING id, name
+    ),
+    -- Claims each url once across all partitions; a url stored before, under any date, is skipped
+    new_urls AS (
+        INSERT INTO article_urls (url, date)
+        SELECT DISTINCT ON (url) url, date
+        FROM articles_staging
+        ORDER BY url, date
+        ON CONFLICT (url) DO NOTHING
+        RETURNING url, date
+    )
+    INSERT INTO articles (url, title, date, content, title_embedding, keyword, minhash, source_id)
+    SELECT DISTINCT ON (staging.url)
+        staging.url, staging.title, staging.date, staging.content, staging.title_embedding,
+        staging.keyword, staging.minhash, upserted_sources.id
+    FROM articles_staging staging
+    JOIN new_urls ON new_urls.url = staging.url AND new_urls.date = staging.date
+    LEFT JOIN upserted_sources ON upserted_sources.name = LEFT(staging.source_name, 255)
+    ORDER BY staging.url
+    ON CONFLICT DO NOTHING
+    RETURNING id, url;
+"""
+
+# Runs after the merge so duplicates can point at canonical articles from the same flush.
+# Both sides are matched on their date as well, so each lookup touches one partition.
+LINK_DUPLICATES = """
+    UPDATE articles
+    SET duplicate_of = canonical.id
+    FROM articles_staging staging
+    JOIN article_urls canonical_url ON canonical_url.url = staging.canonical_url
+    JOIN articles canonical ON canonical.url = canonical_url.url AND canonical.date = canonical_url.date
+    WHERE articles.url = staging.url AND articles.date = staging.date AND articles.duplicate_of IS NULL;
+"""
+
+
+class ArticleWriter:
+    """
+    Buffers shaped articles and writes them in bulk: one binary COPY into a
+    temporary staging table, then one statement that upserts their sources
+    and inserts the articles.
+    """
+
+    def __init__(self, flush_size: int = BULK_FLUSH_SIZE):
+        self.flush_size = flush_size
+        self.inserted = []
+        self._buffer = []
+        self._lock = asyncio.Lock()
+
+    async def add(self, article: dict):
+        self._buffer.append(article)
+        if len(self._buffer) >= self.flush_size:
+            await self.flush()
+
+    async def flush(self) -> list:
+        async with self._lock:
+            articles, self._buffer = self._buffer, []
+            if not articles:
+                return []
+
+            records = [tuple(article.get(column) for column in STAGING_COLUMNS) for article in articles]
+            await ensure_partitions({article["date"] for article in articles})
+
+            async with database.connection() as connection:
+                raw_connection = connection.raw_connection
+                async with raw_connection.transaction():
+                    await raw_connection.execute(CREATE_STAGING)
+                    await raw_connection.copy_records_to_table("articles_staging", records=records, columns=STAGING_COLUMNS)
+                    rows = await raw_connection.fetch(MERGE_STAGING)
+                    await raw_connection.execute(LINK_DUPLICATES)
+
+            inserted = [dict(row) for row in rows]
+            self.inserted.extend(inserted)
+            return inserted
@@ -0,0 +1,95 @@
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+from database import database
+from utils.mmr import normalize_rows
+from utils.vectors import vector_matrix
+
+
+# Enough candidates per (user, day) for MMR to trade relevance for diversity
+CANDIDATES_PER_DAY = int(os.environ.get("USER_CANDIDATES_PER_DAY", 50))
+CANDIDATE_DAYS = int(os.environ.get("USER_CANDIDATE_DAYS", 7))
+
+UPSERT_CANDIDATES = """
+    INSERT INTO user_candidates (user_id, day, article_id, score)
+    SELECT * FROM unnest(CAST(:user_ids AS INTEGER[]), CAST(:days AS DATE[]), CAST(:article_ids AS INTEGER[]), CAST(:scores AS REAL[]))
+    ON CONFLICT (user_id, day, article_id) DO UPDATE SET score = EXCLUDED.score
+"""
+
+TRIM_CANDIDATES = """
+    DELETE FROM user_candidates
+    USING (
+        SELECT user_id, day, article_id,
+            ROW_NUMBER() OVER (PARTITION BY user_id, day ORDER BY score DESC, article_id) AS rank
+        FROM user_candidates
+        WHERE day = ANY(:days)
+    ) ranked
+    WHERE user_candidates.user_id = ranked.user_id
+        AND user_candidates.day = ranked.day
+        AND user_candidates.article_id = ranked.article_id
+        AND ranked.rank > :limit
+"""
+
+REBUILD_CANDIDATES = """
+    INSERT INTO user_candidates (user_id, day, article_id, score)
+    SELECT :user_id, CAST(:day AS DATE), id, 1 - (title_embedding <=> :embedding)
+    FROM articles
+    WHERE date >= :start_of_day AND date < :end_of_day AND duplicate_of IS NULL
+    ORDER BY title_embedding <=> :embedding
+    LIMIT :limit
+    ON CONFLICT (user_id, day, article_id) DO UPDATE SET score = EXCLUDED.score
+"""
+
+
+async def score_articles(articles: list, limit: int = CANDIDATES_PER_DAY):
+    """
+    Scores newly inserted articles (id, date, title_embedding) against every
+    user's preference in one matrix product, and merges the best `limit` per
+    user and day into `user_candidates`, which stays bounded at `limit`.
+    """
+    if not articles:
+        return
+
+    users = await database.fetch_all('SELECT id, preference_embedding FROM "user" WHERE preference_embedding IS NOT NULL')
+    if not users:
+        return
+
+    # Cosine similarity, the same measure the candidate query and MMR rank by
+    scores = normalize_rows(vector_matrix(users, 'preference_embedding')) @ normalize_rows(vector_matrix(articles, 'title_embedding')).T
+    article_days = np.array([article['date'].date() for article in articles])
+    user_ids = np.array([user['id'] for user in users])
+    article_ids = np.array([article['id'] for article in articles])
+
+    values = {"user_ids": [], "days": [], "article_ids": [], "scores": []}
+    for day in set(article_days):
+        columns = np.flatnonzero(article_days == day)
+        day_scores = scores[:, columns]
+        top = min(limit, len(columns))
+        best = np.argpartition(-day_scores, top - 1, axis=1)[:, :top]
+
+        values["user_ids"].extend(np.repeat(user_ids, top).tolist())
+        values["days"].extend([day] * (len(users) * top))
+        values["article_ids"].extend(article_ids[columns[best]].ravel().tolist())
+        values["scores"].extend(np.take_along_axis(day_scores, best, axis=1).ravel().tolist())
+
+    await database.execute(UPSERT_CANDIDATES, values)
+    await database.execute(TRIM_CANDIDATES, {"days": sorted(set(article_days)), "limit": limit})
+
+
+async def rebuild_user_candidates(user_id: int, embedding, days: int = CANDIDATE_DAYS, limit: int = CANDIDATES_PER_DAY):
+    # After a preference change the stored scores are stale, so rank the stored articles again
+    today = datetime.now().date()
+    async with database.transaction():
+        await database.execute("DELETE FROM user_candidates WHERE user_id = :user_id", {"user_id": user_id})
+        for day_offset in range(days):
+            day = today - timedelta(days=day_offset)
+            start_of_day = datetime.combine(day, datetime.min.time())
+            await database.execute(REBUILD_CANDIDATES, {
+                "user_id": user_id,
+                "day": day,
+                "embedding": embedding,
+                "start_of_day": start_of_day,
+                "end_of_day": start_of_day + timedelta(days=1),
+                "limit": limit,
+            })
@@ -0,0 +1,150 @@
+import asyncio
+import math
+import os
+from datetime import date, datetime
+
+import numpy as np
+from database import database
+from dal import iterate
+from utils.ai import candidate_query, fetch_selected_articles, summarize_articles, CANDIDATE_LIMIT, REPORT_MAX_ARTICLES
+from utils.candidates import CANDIDATES_PER_DAY
+from utils.llm_cache import llm_cache
+from utils.mmr import mmr, normalize_rows
+from utils.vectors import stream_vector_matrix
+
+
+# 0 picks sqrt(users / 2) clusters
+USER_CLUSTERS = int(os.environ.get("USER_CLUSTERS", 0))
+# Smaller clusters get no shared digest, their members' reports are personal anyway
+CLUSTER_MIN_MEMBERS = int(os.environ.get("CLUSTER_MIN_MEMBERS", 2))
+KMEANS_ITERATIONS = 25
+
+# The union of the members' precomputed candidates, best scored first
+CLUSTER_POOL = """
+    SELECT articles.id, articles.title_embedding
+    FROM articles
+    JOIN (
+        SELECT article_id, MAX(score) AS score
+        FROM user_candidates
+        WHERE user_id = ANY($1::INTEGER[]) AND day = $2
+        GROUP BY article_id
+    ) pool ON pool.article_id = articles.id
+    WHERE articles.duplicate_of IS NULL
+    ORDER BY pool.score DESC, articles.id
+    LIMIT $3
+"""
+
+
+def kmeans(vectors, k: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0):
+    """Spherical k-means with k-means++ seeding; returns the label of each row and the unit centroids."""
+    vectors = normalize_rows(np.asarray(vectors, dtype=np.float32))
+    k = max(1, min(k, len(vectors)))
+    rng = np.random.default_rng(seed)
+
+    centroids = vectors[[rng.integers(len(vectors))]]
+    while len(centroids) < k:
+        distances = np.clip(1 - np.max(vectors @ centroids.T, axis=1), 0, None)
+        probabilities = distances / distances.sum() if distances.sum() > 0 else None
+        centroids = np.vstack([centroids, vectors[rng.choice(len(vectors), p=probabilities)]])
+
+    for _ in range(iterations):
+        labels = np.argmax(vectors @ centroids.T, axis=1)
+        updated = normalize_rows(np.stack([
+            vectors[labels == index].mean(axis=0) if np.any(labels == index) else centroids[index]
+            for index in range(k)
+        ]))
+        if np.allclose(updated, centroids):
+            break
+        centroids = updated
+
+    return np.argmax(vectors @ centroids.T, axis=1), centroids
+
+
+def cluster_count(users: int) -> int:
+    return USER_CLUSTERS or max(1, round(math.sqrt(users / 2)))
+
+
+async def daily_clusters(day: date) -> dict:
+    """
+    Members and centroid of each cluster for the day. Users are clustered by
+    preference embedding once per day; later calls reuse the assignment.
+    """
+    users = await database.fetch_all('SELECT id, preference_embedding FROM "user" WHERE preference_embedding IS NOT NULL ORDER BY id')
+    embeddings = {user['id']: np.asarray(user['preference_embedding'], dtype=np.float32) for user in users}
+
+    rows = await database.fetch_all("SELECT user_id, cluster FROM user_clusters WHERE day = :day", {"day": day})
+    labels = {row['user_id']: row['cluster'] for row in rows if row['user_id'] in embeddings}
+    if not labels and len(embeddings) >= CLUSTER_MIN_MEMBERS:
+        user_ids = list(embeddings)
+        assignments, _ = kmeans(np.stack([embeddings[user_id] for user_id in user_ids]), cluster_count(len(user_ids)))
+        labels = dict(zip(user_ids, assignments.tolist()))
+        await database.execute_many(
+            "INSERT INTO user_clusters (day, user_id, cluster) VALUES (:day, :user_id, :cluster) ON CONFLICT DO NOTHING",
+            [{"day": day, "user_id": user_id, "cluster": cluster} for user_id, cluster in labels.items()]
+        )
+
+    members = {}
+    for user_id, cluster in labels.items():
+        members.setdefault(cluster, []).append(user_id)
+    return {
+        cluster: (user_ids, normalize_rows(np.stack([embeddings[user_id] for user_id in user_ids]).mean(axis=0, keepdims=True))[0])
+        for cluster, user_ids in sorted(members.items())
+    }
+
+
+async def build_cluster_digest(day: date, cluster: int, members: list, centroid, lambda_param: float = 0.8):
+    """
+    Selects the cluster's articles from the shared pool with the centroid as the
+    preference. Members whose own selection overlaps it take this one, so their
+    reports share a single cached report call. Its summaries are only prepared
+    ahead once a member took the selection that day; until then nothing is
+    spent on a selection nobody may use.
+    """
+    pool_size = CANDIDATES_PER_DAY * len(members)
+    candidate_ids, candidate_embeddings = await stream_vector_matrix(
+        iterate("cluster_pool", CLUSTER_POOL, members, day, pool_size), 'title_embedding', pool_size
+    )
+    if not candidate_ids:
+        start_of_day = datetime.combine(day, datetime.min.time())
+        end_of_day = datetime.combine(day, datetime.max.time())
+        candidate_ids, candidate_embeddings = await stream_vector_matrix(iterate(
+            "candidate_search", candidate_query(), start_of_day, end_of_day, centroid, CANDIDATE_LIMIT
+        ), 'title_embedding', CANDIDATE_LIMIT)
+    if not candidate_ids:
+        return None
+
+    selected_ids = mmr(candidate_embeddings, candidate_ids, centroid, lambda_param, REPORT_MAX_ARTICLES)
+    articles = await fetch_selected_articles(selected_ids)
+    article_ids = [article['id'] for article in articles]
+
+    matches = await database.fetch_val("""
+        INSERT INTO cluster_selections (day, cluster, members, article_ids, updated_at)
+        VALUES (:day, :cluster, :members, :article_ids, :now)
+        ON CONFLICT (day, cluster) DO UPDATE
+        SET members = EXCLUDED.members, article_ids = EXCLUDED.article_ids, updated_at = EXCLUDED.updated_at
+        RETURNING matches
+    """, {"day": day, "cluster": cluster, "members": len(members), "article_ids": article_ids, "now": datetime.now()})
+    if matches:
+        await summarize_articles(articles)
+    return article_ids
+
+
+async def build_shared_digests(day: date = None, stop_event: asyncio.Event = None):
+    day = day or datetime.now().date()
+    clusters = await daily_clusters(day)
+
+    built = 0
+    for cluster, (members, centroid) in clusters.items():
+        if stop_event and stop_event.is_set():
+            return
+        if len(members) < CLUSTER_MIN_MEMBERS:
+            continue
+        try:
+            if await build_cluster_digest(day, cluster, members, centroid):
+                built += 1
+        except Exception as e:
+            print(f"Shared digest for cluster {cluster} on {day} failed: {e}")
+
+    print(f"Built {built} shared digests for {sum(len(members) for members, _ in clusters.values())} users in {len(clusters)} clusters ({day})")
+    for savings in await llm_cache.savings(days=1):
+        print(f"LLM savings on {savings['day']}: {savings['calls']} calls, {savings['prompt_tokens']} prompt and {savings['completion_tokens']} completion tokens")
@@ -0,0 +1,51 @@
+import re
+
+
+CONTEXT_OPEN = re.compile(r'<context id="(\d+)">')
+CONTEXT_CLOSE = '</context>'
+
+
+class ContextStreamParser:
+    """
+    Incrementally parses `<context id="...">...</context>` sections out of a
+    report as it streams in, emitting each section as soon as its tag closes.
+    Yields the same sections as matching the full text against
+    `<context id="(\\d+)">(.*?)</context>`.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._article_id = None
+        self._count = 0
+
+    def feed(self, chunk: str) -> list:
+        self._buffer += chunk
+        sections = []
+
+        while True:
+            if self._article_id is None:
+                match = CONTEXT_OPEN.search(self._buffer)
+                if match is None:
+                    # Text between sections is dropped, but an opening tag may be split across chunks
+                    start = self._buffer.rfind('<')
+                    self._buffer = self._buffer[start:] if start != -1 else ""
+                    return sections
+                self._article_id = int(match.group(1))
+                self._buffer = self._buffer[match.end():]
+
+            end = self._buffer.find(CONTEXT_CLOSE)
+            if end == -1:
+                return sections
+
+            self._count += 1
+            sections.append({
+                "id": self._count,
+                "content": self._buffer[:end],
+                "article_id": self._article_id
+            })
+            self._article_id = None
+            self._buffer = self._buffer[end + len(CONTEXT_CLOSE):]
+
+
+def parse_sections(report_text: str) -> list:
+    return ContextStreamParser().feed(report_text)
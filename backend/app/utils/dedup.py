@@ -0,0 +1,125 @@
+import os
+import re
+import zlib
+from datetime import datetime, timedelta
+
+import numpy as np
+from database import database
+
+
+NUM_PERMUTATIONS = 128
+BANDS = 32
+SHINGLE_SIZE = 5
+# Mersenne prime 2^31 - 1 keeps a * x + b within uint64
+PRIME = (1 << 31) - 1
+
+DEDUP_WINDOW_DAYS = int(os.environ.get("DEDUP_WINDOW_DAYS", 7))
+DEDUP_MAX_DATE_GAP = timedelta(days=float(os.environ.get("DEDUP_MAX_DATE_GAP_DAYS", 2)))
+# Content this similar is a duplicate on its own; less similar content also needs near-identical titles
+DEDUP_JACCARD = float(os.environ.get("DEDUP_JACCARD", 0.7))
+DEDUP_JACCARD_WITH_TITLE = float(os.environ.get("DEDUP_JACCARD_WITH_TITLE", 0.3))
+DEDUP_TITLE_SIMILARITY = float(os.environ.get("DEDUP_TITLE_SIMILARITY", 0.9))
+
+_rng = np.random.default_rng(1)
+_A = _rng.integers(1, PRIME, NUM_PERMUTATIONS, dtype=np.uint64)
+_B = _rng.integers(0, PRIME, NUM_PERMUTATIONS, dtype=np.uint64)
+
+
+def shingles(text: str) -> set:
+    words = re.findall(r'\w+', text.lower())
+    if len(words) <= SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def minhash(text: str) -> bytes:
+    hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) % PRIME for shingle in shingles(text)), dtype=np.uint64)
+    if hashes.size == 0:
+        return np.full(NUM_PERMUTATIONS, PRIME, dtype=np.uint32).tobytes()
+    return ((np.outer(_A, hashes) + _B[:, None]) % PRIME).min(axis=1).astype(np.uint32).tobytes()
+
+
+def jaccard(a, b) -> float:
+    return float(np.mean(np.frombuffer(a, dtype=np.uint32) == np.frombuffer(b, dtype=np.uint32)))
+
+
+class MinHashIndex:
+    """
+    LSH index over MinHash signatures: signatures are split into bands and only
+    articles sharing at least one band bucket are compared, so a lookup touches
+    a handful of candidates instead of every recent article.
+    """
+
+    def __init__(self, bands: int = BANDS):
+        self.bands = bands
+        self._buckets = [{} for _ in range(bands)]
+        self._entries = {}
+
+    def _band_keys(self, signature: bytes):
+        size = len(signature) // self.bands
+        return [signature[i:i + size] for i in range(0, len(signature), size)]
+
+    def add(self, url: str, signature, embedding, date: datetime):
+        if url in self._entries:
+            return
+        self._entries[url] = (signature, embedding, date)
+        for bucket, key in zip(self._buckets, self._band_keys(signature)):
+            bucket.setdefault(key, []).append(url)
+
+    def find_duplicate(self, signature, embedding, date: datetime):
+        candidates = set()
+        for bucket, key in zip(self._buckets, self._band_keys(signature)):
+            candidates.update(bucket.get(key, ()))
+
+        best_url, best_similarity = None, 0.0
+        for url in candidates:
+            other_signature, other_embedding, other_date = self._entries[url]
+            if abs(date - other_date) > DEDUP_MAX_DATE_GAP:
+                continue
+
+            similarity = jaccard(signature, other_signature)
+            if similarity < DEDUP_JACCARD:
+                if similarity < DEDUP_JACCARD_WITH_TITLE:
+                    continue
+                title_similarity = np.dot(embedding, other_embedding) / (np.linalg.norm(embedding) * np.linalg.norm(other_embedding))
+                if title_similarity < DEDUP_TITLE_SIMILARITY:
+                    continue
+
+            if similarity > best_similarity:
+                best_url, best_similarity = url, similarity
+
+        return best_url
+
+    def prune(self, before: datetime):
+        expired = {url for url, (_, _, date) in self._entries.items() if date < before}
+        if not expired:
+            return
+        for url in expired:
+            del self._entries[url]
+        for bucket in self._buckets:
+            for key in list(bucket):
+                bucket[key] = [url for url in bucket[key] if url not in expired]
+                if not bucket[key]:
+                    del bucket[key]
+
+
+_index = None
+
+
+async def get_index() -> MinHashIndex:
+    global _index
+    since = datetime.now() - timedelta(days=DEDUP_WINDOW_DAYS)
+
+    if _index is None:
+        _index = MinHashIndex()
+        rows = await database.fetch_all("""
+            SELECT url, minhash, title_embedding, date
+            FROM articles
+            WHERE date >= :since AND duplicate_of IS NULL AND minhash IS NOT NULL
+        """, {"since": since})
+        for row in rows:
+            _index.add(row['url'], row['minhash'], row['title_embedding'], row['date'])
+    else:
+        _index.prune(since)
+
+    return _index
@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import os
+import random
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+import httpx
+from database import database
+
+
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36"
+
+DOWNLOAD_BACKEND = os.environ.get("DOWNLOAD_BACKEND", "http")
+DOWNLOAD_MAX_CONNECTIONS = int(os.environ.get("DOWNLOAD_MAX_CONNECTIONS", 100))
+DOWNLOAD_PER_HOST = int(os.environ.get("DOWNLOAD_PER_HOST", 4))
+DOWNLOAD_TIMEOUT = float(os.environ.get("DOWNLOAD_TIMEOUT", 15))
+# Failed URLs are retried after RETRY_BASE, doubling per failure up to RETRY_MAX
+DOWNLOAD_RETRY_BASE = timedelta(hours=float(os.environ.get("DOWNLOAD_RETRY_BASE_HOURS", 6)))
+DOWNLOAD_RETRY_MAX = timedelta(hours=float(os.environ.get("DOWNLOAD_RETRY_MAX_HOURS", 7 * 24)))
+
+
+class FetchStates:
+    """The fetch states of one crawl: as loaded from `url_fetch_state`, and the updates to write back."""
+
+    def __init__(self, loaded: dict):
+        self.loaded = loaded
+        self.updates = {}
+
+    def get(self, url: str):
+        return self.loaded.get(url)
+
+
+class Downloader:
+    """
+    Fetches article HTML over a shared keep-alive connection pool, with a
+    per-host concurrency limit. Remembers validators (ETag/Last-Modified) and
+    failures per URL in `url_fetch_state`, so repeated crawls make conditional
+    requests and skip URLs that recently failed.
+    """
+
+    def __init__(self, max_connections: int = DOWNLOAD_MAX_CONNECTIONS, per_host: int = DOWNLOAD_PER_HOST, timeout: float = DOWNLOAD_TIMEOUT, transport: httpx.AsyncBaseTransport = None):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.transport = transport
+        self._client = None
+        self._host_semaphores = defaultdict(lambda: asyncio.Semaphore(per_host))
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers={"User-Agent": USER_AGENT},
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+                timeout=self.timeout,
+                follow_redirects=True,
+                transport=self.transport,
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def load_states(self, urls: list) -> FetchStates:
+        rows = await database.fetch_all(
+            "SELECT url, etag, last_modified, failures, retry_after FROM url_fetch_state WHERE url = ANY(:urls)",
+            {"urls": urls}
+        )
+        return FetchStates({row['url']: dict(row) for row in rows})
+
+    def should_fetch(self, state: dict) -> bool:
+        return not (state and state['retry_after'] and state['retry_after'] > datetime.now())
+
+    async def fetch(self, url: str, states: FetchStates):
+        state = states.get(url)
+        headers = {}
+        if state and state['etag']:
+            headers["If-None-Match"] = state['etag']
+        if state and state['last_modified']:
+            headers["If-Modified-Since"] = state['last_modified']
+
+        try:
+            async with self._host_semaphores[urlsplit(url).netloc]:
+                response = await self.client.get(url, headers=headers)
+        except httpx.HTTPError:
+            self.record_failure(url, states)
+            return None
+
+        if response.status_code == 304:
+            # Same page that failed to yield an article last time
+            self.record_failure(url, states)
+            return None
+
+        if response.status_code >= 400:
+            self.record_failure(url, states)
+            return None
+
+        states.updates[url] = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "failures": 0,
+            "retry_after": None,
+        }
+        return response.text
+
+    def record_failure(self, url: str, states: FetchStates):
+        # Backoff grows from the stored failures, also when this crawl downloaded the page first
+        failures = ((states.get(url) or {}).get('failures') or 0) + 1
+        validators = states.updates.get(url) or states.get(url) or {}
+        states.updates[url] = {
+            "url": url,
+            "etag": validators.get('etag'),
+            "last_modified": validators.get('last_modified'),
+            "failures": failures,
+            "retry_after": datetime.now() + min(DOWNLOAD_RETRY_BASE * 2 ** (failures - 1), DOWNLOAD_RETRY_MAX),
+        }
+
+    async def flush_states(self, states: FetchStates):
+        # Stored articles are skipped by URL before fetching, so only failures need remembering,
+        # and successes of URLs that failed before to reset their backoff
+        states = [state for url, state in states.updates.items() if state['failures'] or url in states.loaded]
+        if not states:
+            return
+
+        await database.execute_many("""
+            INSERT INTO url_fetch_state (url, etag, last_modified, failures, retry_after, updated_at)
+            VALUES (:url, :etag, :last_modified, :failures, :retry_after, :updated_at)
+            ON CONFLICT (url) DO UPDATE
+            SET etag = EXCLUDED.etag,
+                last_modified = EXCLUDED.last_modified,
+                failures = EXCLUDED.failures,
+                retry_after = EXCLUDED.retry_after,
+                updated_at = EXCLUDED.updated_at
+        """, [state | {"updated_at": datetime.now()} for state in states])
+
+
+class FakeArticleTransport(httpx.AsyncBaseTransport):
+    """
+    Serves a deterministic article page for any URL, for tests and benchmarks.
+    A /YYYY-MM-DD/ path segment sets the publish date, otherwise it is today.
+    """
+
+    SYLLABLES = ("ka", "lo", "mi", "ne", "ru", "sa", "to", "vi", "be", "da", "fo", "gu", "hi", "ja", "po", "ze")
+
+    def __init__(self, latency: float = 0.0, paragraphs: int = 6, words_per_paragraph: int = 60):
+        self.latency = latency
+        self.paragraphs = paragraphs
+        self.words_per_paragraph = words_per_paragraph
+        self.requests = 0
+
+    def words(self, rng: random.Random, count: int) -> list:
+        return ["".join(rng.choices(self.SYLLABLES, k=rng.randint(1, 4))) for _ in range(count)]
+
+    def page(self, url: str) -> str:
+        rng = random.Random(hashlib.sha256(url.encode('utf-8')).digest())
+        match = re.search(r"/(\d{4}-\d{2}-\d{2})/", url)
+        published = match.group(1) if match else f"{datetime.now():%Y-%m-%d}"
+        title = " ".join(self.words(rng, 8)).capitalize()
+        body = "".join(
+            f"<p>{' '.join(self.words(rng, self.words_per_paragraph)).capitalize()}.</p>"
+            for _ in range(self.paragraphs)
+        )
+        return f"""<html><head>
+            <title>{title}</title>
+            <meta property="og:title" content="{title}">
+            <meta property="og:site_name" content="{urlsplit(url).netloc}">
+            <meta property="article:published_time" content="{published}T08:00:00">
+            </head><body><article><h1>{title}</h1>{body}</article></body></html>"""
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return httpx.Response(200, html=self.page(str(request.url)), request=request)
+
+
+def get_transport():
+    if DOWNLOAD_BACKEND == "fake":
+        return FakeArticleTransport(latency=float(os.environ.get("FAKE_DOWNLOAD_LATENCY", 0)))
+    return None
+
+
+downloader = Downloader(transport=get_transport())
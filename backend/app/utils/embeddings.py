@@ -0,0 +1,263 @@
+import asyncio
+import hashlib
+import os
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+import numpy as np
+from database import database
+from utils.metrics import registry, span, Counter, Gauge
+
+
+EMBEDDINGS_BACKEND = os.environ.get("EMBEDDINGS_BACKEND", "langchain")
+EMBEDDINGS_SIZE = int(os.environ.get("EMBEDDINGS_SIZE", 1024))
+BATCH_SIZE = int(os.environ.get("EMBEDDINGS_BATCH_SIZE", 64))
+BATCH_MAX_WAIT = float(os.environ.get("EMBEDDINGS_BATCH_MAX_WAIT", 0.05))
+MAX_CONCURRENT_BATCHES = int(os.environ.get("EMBEDDINGS_MAX_CONCURRENT_BATCHES", 4))
+CACHE_MAX_BYTES = int(os.environ.get("EMBEDDINGS_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+CACHE_PERSISTENT = os.environ.get("EMBEDDINGS_CACHE_PERSISTENT", "true").lower() == "true"
+
+
+embedding_requests = registry.register(Counter("news_embedding_requests_total", "Paid embedding API calls", ("model",)))
+embedding_texts = registry.register(Counter("news_embedding_texts_total", "Texts sent to the embedding API", ("model",)))
+
+
+class EmbeddingBackend(ABC):
+    name: str
+    dimensions: int
+
+    @abstractmethod
+    def embed_documents(self, texts: list) -> list:
+        ...
+
+
+class LangChainEmbeddingBackend(EmbeddingBackend):
+    def __init__(self, model, name: str, dimensions: int):
+        self.model = model
+        self.name = name
+        self.dimensions = dimensions
+
+    def embed_documents(self, texts: list) -> list:
+        return self.model.embed_documents(texts)
+
+
+class FakeEmbeddingBackend(EmbeddingBackend):
+    """Deterministic embeddings derived from a hash of the text, for tests and benchmarks."""
+
+    def __init__(self, dimensions: int = EMBEDDINGS_SIZE, latency: float = 0.0):
+        self.name = "fake"
+        self.dimensions = dimensions
+        self.latency = latency
+
+    def embed_documents(self, texts: list) -> list:
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def _embed(self, text: str):
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+        vector = np.random.default_rng(seed).standard_normal(self.dimensions).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+
+def get_backend() -> EmbeddingBackend:
+    if EMBEDDINGS_BACKEND == "fake":
+        return FakeEmbeddingBackend(latency=float(os.environ.get("FAKE_EMBEDDINGS_LATENCY", 0)))
+
+    from utils.ai import embeddings_model, embeddings_model_name
+    return LangChainEmbeddingBackend(embeddings_model, embeddings_model_name, EMBEDDINGS_SIZE)
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def cache_key(model: str, dimensions: int, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{dimensions}\0{normalize_text(text)}".encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache: an in-process LRU bounded by `max_bytes`, backed by
+    the `embedding_cache` table so entries survive restarts.
+    """
+
+    # Rough per-entry cost of the key, the OrderedDict slot and the array header
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES, persistent: bool = CACHE_PERSISTENT):
+        self.max_bytes = max_bytes
+        self.persistent = persistent
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        embedding = self._entries.get(key)
+        if embedding is None:
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return embedding
+
+    def put(self, key: str, embedding):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self._entries[key] = embedding
+        self._bytes += embedding.nbytes + self.ENTRY_OVERHEAD
+
+        while self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes + self.ENTRY_OVERHEAD
+            self.evictions += 1
+
+    async def load(self, keys: list) -> dict:
+        if not (self.persistent and keys):
+            return {}
+
+        rows = await database.fetch_all(
+            "SELECT key, embedding FROM embedding_cache WHERE key = ANY(:keys)",
+            {"keys": keys}
+        )
+        found = {row['key']: row['embedding'] for row in rows}
+        for key, embedding in found.items():
+            self.put(key, embedding)
+        self.persistent_hits += len(found)
+        return found
+
+    async def store(self, model: str, embeddings: dict):
+        for key, embedding in embeddings.items():
+            self.put(key, embedding)
+
+        if not (self.persistent and embeddings):
+            return
+
+        await database.execute_many("""
+            INSERT INTO embedding_cache (key, model, embedding)
+            VALUES (:key, :model, :embedding)
+            ON CONFLICT (key) DO NOTHING
+        """, [
+            {"key": key, "model": model, "embedding": embedding}
+            for key, embedding in embeddings.items()
+        ])
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+
+class EmbeddingBatcher:
+    """
+    Collects concurrent embed requests into batches of up to `batch_size` texts,
+    waiting at most `max_wait` seconds for a batch to fill. Each batch is sent with
+    a single `embed_documents` call in a worker thread. Texts found in `cache` skip
+    the backend entirely.
+    """
+
+    def __init__(self, backend: EmbeddingBackend, cache: EmbeddingCache = None, batch_size: int = BATCH_SIZE, max_wait: float = BATCH_MAX_WAIT, max_concurrent_batches: int = MAX_CONCURRENT_BATCHES):
+        self.backend = backend
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._semaphore = asyncio.Semaphore(max_concurrent_batches)
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    def key(self, text: str) -> str:
+        return cache_key(self.backend.name, self.backend.dimensions, text)
+
+    async def embed(self, text: str):
+        key = self.key(text)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((key, text, future))
+
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    async def embed_many(self, texts: list) -> list:
+        return await asyncio.gather(*(self.embed(text) for text in texts))
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        task = asyncio.ensure_future(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list):
+        texts = dict((key, text) for key, text, _ in batch)
+
+        async with self._semaphore:
+            try:
+                embeddings = await self.cache.load(list(texts)) if self.cache is not None else {}
+                missing = [key for key in texts if key not in embeddings]
+
+                if missing:
+                    with span("embed_batch"):
+                        computed = await asyncio.to_thread(self.backend.embed_documents, [texts[key] for key in missing])
+                    embedding_requests.inc(model=self.backend.name)
+                    embedding_texts.inc(len(missing), model=self.backend.name)
+                    computed = dict(zip(missing, computed))
+                    if self.cache is not None:
+                        self.cache.misses += len(missing)
+                        await self.cache.store(self.backend.name, computed)
+                    embeddings |= computed
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+        for key, _, future in batch:
+            if not future.done():
+                future.set_result(np.asarray(embeddings[key], dtype=np.float32))
+
+
+cache = EmbeddingCache()
+registry.register(Gauge(
+    "news_embedding_cache", "Embedding cache counters",
+    lambda: {(name,): value for name, value in cache.stats().items()}, ("counter",)
+))
+_batcher = None
+
+
+def get_batcher() -> EmbeddingBatcher:
+    global _batcher
+    if _batcher is None:
+        _batcher = EmbeddingBatcher(get_backend(), cache)
+    return _batcher
+
+
+async def embed(text: str):
+    return await get_batcher().embed(text)
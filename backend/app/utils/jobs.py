@@ -0,0 +1,198 @@
+import asyncio
+import os
+import time
+from contextlib import suppress
+from datetime import date, datetime, timedelta
+
+from fastapi import HTTPException
+from database import database
+from utils.ai import generate_report, stream_report
+
+
+REPORT_WORKERS = int(os.environ.get("REPORT_WORKERS", 2))
+REPORT_JOB_POLL_INTERVAL = float(os.environ.get("REPORT_JOB_POLL_INTERVAL", 2))
+# A running job older than this belonged to a worker that died, it is queued again
+REPORT_JOB_TIMEOUT = timedelta(minutes=float(os.environ.get("REPORT_JOB_TIMEOUT_MINUTES", 30)))
+REPORT_JOB_MAX_ATTEMPTS = int(os.environ.get("REPORT_JOB_MAX_ATTEMPTS", 3))
+
+JOB_COLUMNS = "id, user_id, date, status, report_id, error, attempts, created_at, started_at, finished_at"
+
+
+async def enqueue_report(user_id: int, report_date: date) -> dict:
+    """
+    Queues a report for (user, date) and returns the job. While a job for the
+    same report is queued or running, requests coalesce onto it.
+    """
+    while True:
+        job = await database.fetch_one(f"""
+            INSERT INTO report_jobs (user_id, date, status, created_at)
+            VALUES (:user_id, :date, 'queued', :now)
+            ON CONFLICT (user_id, date) WHERE status IN ('queued', 'running') DO NOTHING
+            RETURNING {JOB_COLUMNS}
+        """, {"user_id": user_id, "date": report_date, "now": datetime.now()})
+        if job:
+            _job_queued.set()
+            return dict(job)
+
+        job = await active_job(user_id, report_date)
+        # Otherwise the active job finished in between, so queue a new one
+        if job:
+            return job
+
+
+async def active_job(user_id: int, report_date: date):
+    job = await database.fetch_one(f"""
+        SELECT {JOB_COLUMNS} FROM report_jobs
+        WHERE user_id = :user_id AND date = :date AND status IN ('queued', 'running')
+    """, {"user_id": user_id, "date": report_date})
+    return dict(job) if job else None
+
+
+async def start_report_job(user_id: int, report_date: date):
+    """
+    Records a report generated outside the queue, i.e. streamed, as a running
+    job so it holds the same (user, date) guard. Returns None while another job
+    for the report is queued or running.
+    """
+    job = await database.fetch_one(f"""
+        INSERT INTO report_jobs (user_id, date, status, attempts, created_at, started_at)
+        VALUES (:user_id, :date, 'running', 1, :now, :now)
+        ON CONFLICT (user_id, date) WHERE status IN ('queued', 'running') DO NOTHING
+        RETURNING {JOB_COLUMNS}
+    """, {"user_id": user_id, "date": report_date, "now": datetime.now()})
+    return dict(job) if job else None
+
+
+async def get_job(job_id: int, user_id: int):
+    return await database.fetch_one(
+        f"SELECT {JOB_COLUMNS} FROM report_jobs WHERE id = :job_id AND user_id = :user_id",
+        {"job_id": job_id, "user_id": user_id}
+    )
+
+
+async def claim_job():
+    return await database.fetch_one("""
+        UPDATE report_jobs
+        SET status = 'running', started_at = :now, attempts = attempts + 1
+        WHERE id = (
+            SELECT id FROM report_jobs
+            WHERE status = 'queued'
+            ORDER BY created_at, id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING id, user_id, date
+    """, {"now": datetime.now()})
+
+
+async def finish_job(job_id: int, status: str, report_id: int = None, error: str = None):
+    await database.execute("""
+        UPDATE report_jobs
+        SET status = :status, report_id = :report_id, error = :error, finished_at = :now
+        WHERE id = :job_id
+    """, {"job_id": job_id, "status": status, "report_id": report_id, "error": error, "now": datetime.now()})
+
+
+async def requeue_stale_jobs():
+    cutoff = datetime.now() - REPORT_JOB_TIMEOUT
+    await database.execute("""
+        UPDATE report_jobs
+        SET status = CASE WHEN attempts >= :max_attempts THEN 'failed' ELSE 'queued' END,
+            error = CASE WHEN attempts >= :max_attempts THEN 'Timed out' ELSE error END
+        WHERE status = 'running' AND started_at < :cutoff
+    """, {"cutoff": cutoff, "max_attempts": REPORT_JOB_MAX_ATTEMPTS})
+
+
+async def run_job(job):
+    user = await database.fetch_one('SELECT id, preference_embedding FROM "user" WHERE id = :user_id', {"user_id": job['user_id']})
+    if user is None or user['preference_embedding'] is None:
+        await finish_job(job['id'], "skipped", error="User has no preference")
+        return
+
+    try:
+        report_id = await generate_report(dict(user), day_offset=(datetime.now().date() - job['date']).days)
+    except HTTPException as e:
+        await finish_job(job['id'], "skipped", error=e.detail)
+        return
+    except Exception as e:
+        print(f"Report job {job['id']} failed: {e}")
+        await finish_job(job['id'], "failed", error=str(e))
+        return
+
+    await finish_job(job['id'], "done", report_id=report_id)
+
+
+async def stream_job(job_id: int, user: dict, report_date: date, articles: list):
+    """Streams the report of a job from start_report_job and finishes the job the way run_job does."""
+    try:
+        async for event in stream_report(user, report_date, articles):
+            if event["type"] == "done":
+                await finish_job(job_id, "done", report_id=event["report_id"])
+            yield event
+    except Exception as e:
+        print(f"Report job {job_id} failed: {e}")
+        await finish_job(job_id, "failed", error=str(e))
+        raise
+
+
+_job_queued = asyncio.Event()
+
+
+class ReportWorkerPool:
+    """
+    Runs queued report jobs with `size` workers in this process. Any number of
+    processes can run a pool against the same queue; SKIP LOCKED hands each
+    job to exactly one worker.
+    """
+
+    def __init__(self, size: int = REPORT_WORKERS, poll_interval: float = REPORT_JOB_POLL_INTERVAL):
+        self.size = size
+        self.poll_interval = poll_interval
+        self._tasks = []
+        self._stop_event = asyncio.Event()
+        self._requeued_at = 0.0
+
+    def start(self):
+        self._stop_event.clear()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.size)]
+
+    async def stop(self):
+        self._stop_event.set()
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with suppress(asyncio.CancelledError):
+                await task
+        self._tasks = []
+
+    async def _wait(self):
+        if time.monotonic() - self._requeued_at > 60:
+            self._requeued_at = time.monotonic()
+            await requeue_stale_jobs()
+
+        # Local enqueues wake workers right away, jobs from other processes are polled
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(_job_queued.wait(), self.poll_interval)
+        _job_queued.clear()
+
+    async def _work(self):
+        while not self._stop_event.is_set():
+            try:
+                job = await claim_job()
+            except Exception as e:
+                print(f"Claiming a report job failed: {e}")
+                job = None
+
+            if job is None:
+                await self._wait()
+                continue
+
+            try:
+                await run_job(job)
+            except asyncio.CancelledError:
+                # Shutting down, leave the job for the next worker
+                await database.execute("UPDATE report_jobs SET status = 'queued' WHERE id = :job_id", {"job_id": job['id']})
+                raise
+
+
+report_workers = ReportWorkerPool()
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+
+from database import database
+from utils.embeddings import normalize_text
+from utils.metrics import registry, Counter, LLM_PRICES
+
+
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_TTL = timedelta(days=float(os.environ.get("LLM_CACHE_TTL_DAYS", 30)))
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# Expired and over-budget entries are evicted after this many writes
+LLM_CACHE_EVICT_EVERY = int(os.environ.get("LLM_CACHE_EVICT_EVERY", 100))
+
+llm_cache_requests = registry.register(Counter("news_llm_cache_requests_total", "LLM cache lookups", ("kind", "result")))
+llm_saved_calls = registry.register(Counter("news_llm_saved_calls_total", "LLM calls answered from the cache", ("kind", "model")))
+llm_saved_tokens = registry.register(Counter("news_llm_saved_tokens_total", "LLM tokens not spent thanks to the cache", ("kind", "model", "type")))
+
+
+def normalize_inputs(value):
+    if isinstance(value, str):
+        return normalize_text(value)
+    if isinstance(value, dict):
+        return {key: normalize_inputs(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize_inputs(item) for item in value]
+    return value
+
+
+def llm_cache_key(kind: str, model: str, version: int, inputs: dict) -> str:
+    payload = json.dumps(normalize_inputs(inputs), sort_keys=True, default=str)
+    return hashlib.sha256(f"{kind}\0{model}\0{version}\0{payload}".encode('utf-8')).hexdigest()
+
+
+class LLMCache:
+    """
+    Exact-match cache of chain outputs in `llm_cache`, keyed by (kind, model,
+    prompt version, normalized inputs). Entries expire after `ttl`; beyond
+    `max_bytes` the least recently used entries are evicted. Every hit is
+    added to the day's `llm_savings` with the tokens the original call used.
+    """
+
+    def __init__(self, enabled: bool = LLM_CACHE_ENABLED, ttl: timedelta = LLM_CACHE_TTL, max_bytes: int = LLM_CACHE_MAX_BYTES):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = {}
+        self.misses = {}
+        self._writes = 0
+
+    async def get(self, kind: str, model: str, version: int, inputs: dict):
+        if not self.enabled:
+            return None
+
+        row = await database.fetch_one("""
+            UPDATE llm_cache SET last_used_at = :now
+            WHERE key = :key AND created_at > :cutoff
+            RETURNING value, prompt_tokens, completion_tokens
+        """, {"key": llm_cache_key(kind, model, version, inputs), "now": datetime.now(), "cutoff": datetime.now() - self.ttl})
+        value = row['value'] if row else None
+        if row:
+            await self.record_savings(kind, model, row['prompt_tokens'] or 0, row['completion_tokens'] or 0)
+
+        counts = self.misses if value is None else self.hits
+        counts[kind] = counts.get(kind, 0) + 1
+        llm_cache_requests.inc(kind=kind, result="miss" if value is None else "hit")
+        return value
+
+    async def put(self, kind: str, model: str, version: int, inputs: dict, value: str, prompt_tokens: int = 0, completion_tokens: int = 0):
+        if not self.enabled:
+            return
+
+        await database.execute("""
+            INSERT INTO llm_cache (key, kind, model, value, size, prompt_tokens, completion_tokens, created_at, last_used_at)
+            VALUES (:key, :kind, :model, :value, :size, :prompt_tokens, :completion_tokens, :now, :now)
+            ON CONFLICT (key) DO UPDATE
+            SET value = EXCLUDED.value, size = EXCLUDED.size, prompt_tokens = EXCLUDED.prompt_tokens,
+                completion_tokens = EXCLUDED.completion_tokens, created_at = EXCLUDED.created_at, last_used_at = EXCLUDED.last_used_at
+        """, {
+            "key": llm_cache_key(kind, model, version, inputs),
+            "kind": kind,
+            "model": model,
+            "value": value,
+            "size": len(value.encode('utf-8')),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "now": datetime.now(),
+        })
+
+        self._writes += 1
+        if self._writes % LLM_CACHE_EVICT_EVERY == 0:
+            await self.evict()
+
+    async def record_savings(self, kind: str, model: str, prompt_tokens: int, completion_tokens: int):
+        llm_saved_calls.inc(kind=kind, model=model)
+        llm_saved_tokens.inc(prompt_tokens, kind=kind, model=model, type="prompt")
+        llm_saved_tokens.inc(completion_tokens, kind=kind, model=model, type="completion")
+        await database.execute("""
+            INSERT INTO llm_savings (day, kind, model, calls, prompt_tokens, completion_tokens)
+            VALUES (:day, :kind, :model, 1, :prompt_tokens, :completion_tokens)
+            ON CONFLICT (day, kind, model) DO UPDATE
+            SET calls = llm_savings.calls + 1,
+                prompt_tokens = llm_savings.prompt_tokens + EXCLUDED.prompt_tokens,
+                completion_tokens = llm_savings.completion_tokens + EXCLUDED.completion_tokens
+        """, {"day": datetime.now().date(), "kind": kind, "model": model, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens})
+
+    async def savings(self, days: int = 7) -> list:
+        """LLM calls and tokens saved per day and kind, newest day first."""
+        rows = await database.fetch_all("""
+            SELECT day, kind, model, calls, prompt_tokens, completion_tokens
+            FROM llm_savings
+            WHERE day > :since
+            ORDER BY day DESC, kind, model
+        """, {"since": datetime.now().date() - timedelta(days=days)})
+
+        report = {}
+        for row in rows:
+            input_price, output_price = LLM_PRICES.get(row['model'], (0, 0))
+            day = report.setdefault(row['day'].isoformat(), {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0, "kinds": {}})
+            kind = day["kinds"].setdefault(row['kind'], {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+            for totals in (day, kind):
+                totals["calls"] += row['calls']
+                totals["prompt_tokens"] += row['prompt_tokens']
+                totals["completion_tokens"] += row['completion_tokens']
+            day["cost_usd"] += (row['prompt_tokens'] * input_price + row['completion_tokens'] * output_price) / 1_000_000
+        return [{"day": day, **totals} for day, totals in report.items()]
+
+    async def evict(self):
+        await database.execute("DELETE FROM llm_cache WHERE created_at <= :cutoff", {"cutoff": datetime.now() - self.ttl})
+        await database.execute("""
+            DELETE FROM llm_cache WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (ORDER BY last_used_at DESC, key) AS total
+                    FROM llm_cache
+                ) ranked
+                WHERE total > :max_bytes
+            )
+        """, {"max_bytes": self.max_bytes})
+
+    def stats(self) -> dict:
+        return {
+            kind: {
+                "hits": self.hits.get(kind, 0),
+                "misses": self.misses.get(kind, 0),
+                "hit_rate": self.hits.get(kind, 0) / (self.hits.get(kind, 0) + self.misses.get(kind, 0)),
+            }
+            for kind in sorted(set(self.hits) | set(self.misses))
+        }
+
+
+llm_cache = LLMCache()
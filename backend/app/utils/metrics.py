@@ -0,0 +1,176 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+import inspect
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# USD per million tokens (input, output); LLM_PRICES="model=input:output,..." overrides
+LLM_PRICES = {
+    "gpt-4o": (2.5, 10),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-3.5-turbo": (0.5, 1.5),
+}
+for entry in filter(None, os.environ.get("LLM_PRICES", "").split(",")):
+    model, prices = entry.split("=")
+    LLM_PRICES[model.strip()] = tuple(float(price) for price in prices.split(":"))
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def quantile(self, q: float, **labels):
+        """Estimate a quantile by interpolating within buckets, like Prometheus' histogram_quantile."""
+        key = tuple(str(labels[name]) for name in self.labels)
+        counts, _ = self._values.get(key, (None, 0.0))
+        if not counts or not sum(counts):
+            return None
+
+        rank = q * sum(counts)
+        cumulative, lower = 0, 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.buckets[-1]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """A value read from `callback` at scrape time, returning {label values tuple: value}."""
+
+    def __init__(self, name: str, documentation: str, callback, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labels = labels
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self.callback().items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+stage_duration = registry.register(Histogram("news_stage_duration_seconds", "Time spent in each pipeline stage", ("stage",)))
+stage_errors = registry.register(Counter("news_stage_errors_total", "Pipeline stage invocations that raised", ("stage",)))
+db_duration = registry.register(Histogram("news_db_query_duration_seconds", "Database call latency by operation", ("operation",)))
+llm_calls = registry.register(Counter("news_llm_calls_total", "LLM calls", ("model",)))
+llm_tokens = registry.register(Counter("news_llm_tokens_total", "LLM tokens", ("model", "type")))
+llm_cost = registry.register(Counter("news_llm_cost_usd_total", "Estimated LLM spend in USD", ("model",)))
+
+
+class span:
+    """Times a block or function as `stage`; works with `with`, `async with` or as a decorator."""
+
+    def __init__(self, stage: str, histogram: Histogram = stage_duration, label: str = "stage"):
+        self.stage = stage
+        self.histogram = histogram
+        self.label = label
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.histogram.observe(time.perf_counter() - self._start, **{self.label: self.stage})
+        if exc_type is not None and exc_type is not GeneratorExit:
+            stage_errors.inc(stage=self.stage)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        return self.__exit__(exc_type, exc, traceback)
+
+    def __call__(self, fn):
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with span(self.stage, self.histogram, self.label):
+                    return await fn(*args, **kwargs)
+        else:
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with span(self.stage, self.histogram, self.label):
+                    return fn(*args, **kwargs)
+        return wrapper
+
+
+def record_llm_usage(model: str, prompt_tokens: int, completion_tokens: int):
+    llm_calls.inc(model=model)
+    llm_tokens.inc(prompt_tokens, model=model, type="prompt")
+    llm_tokens.inc(completion_tokens, model=model, type="completion")
+    input_price, output_price = LLM_PRICES.get(model, (0, 0))
+    llm_cost.inc((prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000, model=model)
+
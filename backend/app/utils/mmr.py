@@ -0,0 +1,41 @@
+import numpy as np
+
+
+def cosine_similarity(a, b):
+    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def mmr(candidate_embeddings, candidate_ids, query_embedding, lambda_param, k):
+    # Ties go to the earliest candidate, i.e. the one the candidate query ranked first
+    if len(candidate_ids) == 0:
+        return []
+
+    candidates = normalize_rows(np.asarray(candidate_embeddings, dtype=np.float32))
+    query = normalize_rows(np.asarray(query_embedding, dtype=np.float32))
+
+    relevance = candidates @ query
+    max_similarity = np.zeros(len(candidate_ids), dtype=np.float32)
+    available = np.ones(len(candidate_ids), dtype=bool)
+    selected = []
+
+    for _ in range(min(k, len(candidate_ids))):
+        if selected:
+            scores = lambda_param * relevance + (1 - lambda_param) * (1 - max_similarity)
+        else:
+            scores = relevance.copy()
+        scores[~available] = -np.inf
+
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+
+        similarity = candidates @ candidates[best]
+        max_similarity = similarity if len(selected) == 1 else np.maximum(max_similarity, similarity)
+
+    return [candidate_ids[index] for index in selected]
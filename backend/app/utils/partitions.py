@@ -0,0 +1,139 @@
+import os
+import re
+from datetime import date, datetime, timedelta
+
+import asyncpg
+from database import database
+from dal import connection
+from utils.candidates import CANDIDATE_DAYS
+
+
+# Articles are range-partitioned by `date`; set the interval before partitions exist
+ARTICLES_PARTITION_INTERVAL = os.environ.get("ARTICLES_PARTITION_INTERVAL", "week")
+ARTICLES_RETENTION = timedelta(days=int(os.environ.get("ARTICLES_RETENTION_DAYS", 365)))
+# "detach" keeps retired partitions as standalone archived_* tables, "drop" deletes them
+ARTICLES_RETENTION_MODE = os.environ.get("ARTICLES_RETENTION_MODE", "detach")
+# Past this age summarized articles keep title, summary and embedding, but not their full text
+ARTICLES_CONTENT_MAX_AGE = timedelta(days=int(os.environ.get("ARTICLES_CONTENT_MAX_AGE_DAYS", 30)))
+CONTENT_STRIP_BATCH_SIZE = 5000
+
+PARTITIONS_LOCK_ID = 4243
+
+LIST_PARTITIONS = """
+    SELECT child.relname AS name, pg_get_expr(child.relpartbound, child.oid) AS bound
+    FROM pg_inherits
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE pg_inherits.inhparent = 'articles'::regclass
+"""
+
+# Unsummarized articles keep their text, it is the only input a later summary can have
+STRIP_CONTENT = """
+    WITH stripped AS (
+        UPDATE articles SET content = NULL
+        WHERE (id, date) IN (
+            SELECT id, date FROM articles
+            WHERE date < $1 AND content IS NOT NULL AND summary IS NOT NULL
+            LIMIT $2
+        )
+        RETURNING 1
+    )
+    SELECT COUNT(*) FROM stripped
+"""
+
+
+def partition_bounds(day: date):
+    if ARTICLES_PARTITION_INTERVAL == "day":
+        return f"articles_d{day:%Y%m%d}", day, day + timedelta(days=1)
+    start = day - timedelta(days=day.weekday())
+    return f"articles_w{start:%Y%m%d}", start, start + timedelta(days=7)
+
+
+def oldest_kept_date() -> datetime:
+    return datetime.combine(datetime.now().date() - ARTICLES_RETENTION, datetime.min.time())
+
+
+_partitions = set()
+
+
+async def list_partitions() -> dict:
+    """Attached partitions by name, with the exclusive upper bound of their range."""
+    async with connection() as raw_connection:
+        rows = await raw_connection.fetch(LIST_PARTITIONS)
+    partitions = {}
+    for row in rows:
+        match = re.search(r"TO \('([^']+)'\)", row['bound'])
+        partitions[row['name']] = datetime.fromisoformat(match.group(1)) if match else None
+    return partitions
+
+
+async def ensure_partitions(dates):
+    """Create the partitions the given dates fall into, unless they exist already."""
+    bounds = {partition_bounds(value.date() if isinstance(value, datetime) else value) for value in dates}
+    missing = sorted(bound for bound in bounds if bound[0] not in _partitions)
+    if not missing:
+        return
+
+    async with connection() as raw_connection:
+        async with raw_connection.transaction():
+            # Serializes creation across processes
+            await raw_connection.execute("SELECT pg_advisory_xact_lock($1)", PARTITIONS_LOCK_ID)
+            existing = {row['name'] for row in await raw_connection.fetch(LIST_PARTITIONS)}
+            for name, start, end in missing:
+                if name not in existing:
+                    try:
+                        async with raw_connection.transaction():
+                            await raw_connection.execute(
+                                f"CREATE TABLE IF NOT EXISTS \"{name}\" PARTITION OF articles FOR VALUES FROM ('{start}') TO ('{end}')"
+                            )
+                    except asyncpg.exceptions.InvalidObjectDefinitionError:
+                        # The range is covered by a partition created with the other interval
+                        pass
+                _partitions.add(name)
+
+
+async def retire_partition(name: str):
+    async with database.transaction():
+        # Nothing references articles by foreign key any more, so clear references by hand,
+        # before and apart from the detach so readers of articles are never blocked meanwhile
+        await database.execute(f'UPDATE articles SET duplicate_of = NULL WHERE duplicate_of IN (SELECT id FROM "{name}")')
+        await database.execute(f'DELETE FROM user_candidates WHERE article_id IN (SELECT id FROM "{name}")')
+        await database.execute(f'DELETE FROM article_urls WHERE url IN (SELECT url FROM "{name}")')
+
+    # CONCURRENTLY only takes a SHARE UPDATE EXCLUSIVE lock on articles, and must run outside a
+    # transaction block. An interrupted detach leaves the partition pending, FINALIZE completes it.
+    async with connection() as raw_connection:
+        pending = await raw_connection.fetchval("SELECT inhdetachpending FROM pg_inherits WHERE inhrelid = $1::regclass", f'"{name}"')
+        await raw_connection.execute(f'ALTER TABLE articles DETACH PARTITION "{name}" {"FINALIZE" if pending else "CONCURRENTLY"}')
+
+    if ARTICLES_RETENTION_MODE == "drop":
+        await database.execute(f'DROP TABLE "{name}"')
+    else:
+        await database.execute(f'ALTER TABLE "{name}" RENAME TO "archived_{name}"')
+    _partitions.discard(name)
+    print(f"Retired article partition {name} ({ARTICLES_RETENTION_MODE})")
+
+
+async def strip_content(older_than: datetime) -> int:
+    stripped = 0
+    while True:
+        async with connection() as raw_connection:
+            count = await raw_connection.fetchval(STRIP_CONTENT, older_than, CONTENT_STRIP_BATCH_SIZE)
+        stripped += count
+        if count < CONTENT_STRIP_BATCH_SIZE:
+            return stripped
+
+
+async def run_retention():
+    today = datetime.now().date()
+    await ensure_partitions([today, today + timedelta(days=7)])
+
+    cutoff = oldest_kept_date()
+    for name, upper_bound in (await list_partitions()).items():
+        if upper_bound is not None and upper_bound <= cutoff:
+            await retire_partition(name)
+
+    stripped = await strip_content(datetime.combine(today - ARTICLES_CONTENT_MAX_AGE, datetime.min.time()))
+    await database.execute("DELETE FROM user_candidates WHERE day < :cutoff", {"cutoff": today - timedelta(days=CANDIDATE_DAYS)})
+    await database.execute("DELETE FROM user_clusters WHERE day < :cutoff", {"cutoff": today - timedelta(days=CANDIDATE_DAYS)})
+    await database.execute("DELETE FROM cluster_selections WHERE day < :cutoff", {"cutoff": today - timedelta(days=CANDIDATE_DAYS)})
+    print(f"Retention: stripped content of {stripped} articles")
@@ -0,0 +1,76 @@
+import asyncio
+from contextlib import suppress
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Iterable
+
+from utils.metrics import span
+
+
+@dataclass
+class Stage:
+    name: str
+    handler: Callable[[Any], Awaitable[Any]]
+    concurrency: int = 1
+
+
+_DONE = object()
+
+
+async def run_pipeline(items: Iterable, stages: list, queue_size: int = 64, stop_event: asyncio.Event = None):
+    """
+    Push items through the stages, each stage running `concurrency` workers.
+
+    Stages are connected by bounded queues, so a slow stage applies backpressure
+    to the ones before it. A handler returning None drops the item. Setting
+    `stop_event` cancels all in-flight work.
+    """
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+
+    async def close(index: int):
+        if index < len(stages):
+            for _ in range(stages[index].concurrency):
+                await queues[index].put(_DONE)
+
+    async def produce():
+        for item in items:
+            if stop_event and stop_event.is_set():
+                break
+            await queues[0].put(item)
+        await close(0)
+
+    async def work(index: int, stage: Stage):
+        queue = queues[index]
+        next_queue = queues[index + 1] if index + 1 < len(queues) else None
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                return
+            try:
+                with span(f"ingest_{stage.name}"):
+                    result = await stage.handler(item)
+            except Exception as e:
+                print(f"Pipeline stage {stage.name} failed: {e}")
+                continue
+            if result is not None and next_queue is not None:
+                await next_queue.put(result)
+
+    async def run_stage(index: int, stage: Stage):
+        await asyncio.gather(*(work(index, stage) for _ in range(stage.concurrency)))
+        await close(index + 1)
+
+    pipeline = asyncio.gather(produce(), *(run_stage(index, stage) for index, stage in enumerate(stages)))
+
+    if not stop_event:
+        await pipeline
+        return
+
+    stopped = asyncio.create_task(stop_event.wait())
+    done, _ = await asyncio.wait({pipeline, stopped}, return_when=asyncio.FIRST_COMPLETED)
+
+    if pipeline in done:
+        stopped.cancel()
+        pipeline.result()
+    else:
+        pipeline.cancel()
+        with suppress(asyncio.CancelledError):
+            await pipeline
@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta
+
+from database import database
+from utils.ai import keyword_chain, get_todays_articles, align_with_cluster, REPORT_MAX_ARTICLES
+from utils.candidates import rebuild_user_candidates
+from utils.embeddings import embed
+from utils.jobs import enqueue_report
+from utils.scheduler import crawl, crawl_window
+
+
+def parse_keywords(text: str) -> list:
+    return [keyword.strip() for keyword in text.split('\n') if keyword.strip()]
+
+
+async def todays_report_article_ids(user_id: int):
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    row = await database.fetch_one("""
+        SELECT article_ids FROM reports
+        WHERE user_id = :user_id AND date >= :start_of_day AND date < :end_of_day
+        ORDER BY created_at DESC
+        LIMIT 1
+    """, {"user_id": user_id, "start_of_day": today, "end_of_day": today + timedelta(days=1)})
+    return row["article_ids"] if row else None
+
+
+async def apply_preference(user_id: int, text: str):
+    """
+    Embeds the preference text and extracts its keywords, re-scores the user's
+    stored candidates, crawls only the keywords that are new for this user,
+    then reselects today's articles and queues today's report again if the
+    selection changed.
+    """
+    embedding = await embed(text)
+    keywords = parse_keywords(await keyword_chain.ainvoke({"preference_text": text}))
+
+    previous = await database.fetch_one('SELECT preference_keywords FROM "user" WHERE id = :user_id', {"user_id": user_id})
+    # A newer update superseded this one while the keywords were being generated
+    updated = await database.fetch_one("""
+        UPDATE "user"
+        SET preference_embedding = :embedding, preference_keywords = :keywords
+        WHERE id = :user_id AND preference_text = :preference
+        RETURNING id, preference_keywords, preference_embedding
+    """, {"embedding": embedding, "keywords": keywords, "user_id": user_id, "preference": text})
+    if not updated:
+        return
+
+    known = {keyword.lower() for keyword in (previous["preference_keywords"] or [])} if previous else set()
+    added = [keyword for keyword in keywords if keyword.lower() not in known]
+    print(f"Preference of user {user_id} updated, {len(added)} of {len(keywords)} keywords are new")
+
+    user = dict(updated)
+    await rebuild_user_candidates(user_id, embedding)
+    if added:
+        await crawl([{**user, "preference_keywords": added}], crawl_window())
+
+    article_ids = await todays_report_article_ids(user_id)
+    if article_ids is None:
+        return
+
+    # Compared the way prepare_report selects, so a report shared with the cluster counts as unchanged
+    selected, _ = await align_with_cluster(user, datetime.now().date(), await get_todays_articles(user, max_articles=REPORT_MAX_ARTICLES))
+    if [article['id'] for article in selected] != list(article_ids):
+        await enqueue_report(user_id, datetime.now().date())
+
+
+async def update_preference_in_background(user_id: int, text: str):
+    try:
+        await apply_preference(user_id, text)
+    except Exception as e:
+        print(f"Preference update for user {user_id} failed: {e}")
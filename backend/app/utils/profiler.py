@@ -0,0 +1,62 @@
+import os
+import sys
+import threading
+from collections import Counter
+
+
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "false").lower() == "true"
+PROFILER_INTERVAL = float(os.environ.get("PROFILER_INTERVAL", 0.01))
+PROFILER_MAX_DEPTH = 64
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all other threads every `interval` seconds from a
+    background thread and aggregates them in collapsed-stack format, ready for
+    flamegraph tools. Overhead is one stack walk per thread per sample.
+    """
+
+    def __init__(self, interval: float = PROFILER_INTERVAL):
+        self.interval = interval
+        self._samples = Counter()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def reset(self):
+        self._samples.clear()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            own_id = threading.get_ident()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < PROFILER_MAX_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self._samples[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self._samples.most_common())
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date as date_type
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+
+REPORT_CACHE_MAX_ENTRIES = int(os.environ.get("REPORT_CACHE_MAX_ENTRIES", 1024))
+# Only invalidations from this process are seen, so the dates index, which can
+# change in another process, is also bounded by a TTL
+REPORT_CACHE_TTL = float(os.environ.get("REPORT_CACHE_TTL", 60))
+
+
+@dataclass
+class CachedResponse:
+    body: bytes
+    etag: str
+    expires_at: float = None
+    report_id: int = None
+
+
+def cached_body(content, report_id: int = None, ttl: float = None) -> CachedResponse:
+    body = json.dumps(jsonable_encoder(content)).encode('utf-8')
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    return CachedResponse(body, etag, time.monotonic() + ttl if ttl else None, report_id)
+
+
+def respond(request: Request, cached: CachedResponse) -> Response:
+    headers = {"ETag": cached.etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == cached.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(cached.body, media_type="application/json", headers=headers)
+
+
+class ReportCache:
+    """
+    Serialized GET /reports/{date} bodies per (user, date), remembering which
+    report id they were rendered from, plus a serialized dates index per user.
+    Report bodies are only served for the report id that is latest now, so a
+    report regenerated by another process is never shadowed.
+    """
+
+    def __init__(self, max_entries: int = REPORT_CACHE_MAX_ENTRIES, ttl: float = REPORT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._reports = OrderedDict()
+        self._dates = {}
+
+    @staticmethod
+    def _valid(cached: CachedResponse) -> bool:
+        return cached is not None and (cached.expires_at is None or cached.expires_at > time.monotonic())
+
+    def get_report(self, user_id: int, report_date: date_type, report_id: int) -> CachedResponse:
+        cached = self._reports.get((user_id, report_date))
+        if not self._valid(cached) or cached.report_id != report_id:
+            return None
+        self._reports.move_to_end((user_id, report_date))
+        return cached
+
+    def put_report(self, user_id: int, report_date: date_type, report: dict) -> CachedResponse:
+        cached = cached_body(report, report["id"])
+        self._reports[(user_id, report_date)] = cached
+        self._reports.move_to_end((user_id, report_date))
+        while len(self._reports) > self.max_entries:
+            self._reports.popitem(last=False)
+        return cached
+
+    def get_dates(self, user_id: int) -> CachedResponse:
+        cached = self._dates.get(user_id)
+        return cached if self._valid(cached) else None
+
+    def put_dates(self, user_id: int, dates: list) -> CachedResponse:
+        cached = cached_body(dates, ttl=self.ttl)
+        self._dates[user_id] = cached
+        return cached
+
+    def invalidate(self, user_id: int, report_date: date_type):
+        self._reports.pop((user_id, report_date), None)
+        self._dates.pop(user_id, None)
+
+
+report_cache = ReportCache()
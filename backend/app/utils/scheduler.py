@@ -0,0 +1,145 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+from database import database
+from utils.ai import presummarize, SHARED_DIGESTS
+from utils.articles import fetch_and_insert_articles
+from utils.clusters import build_shared_digests
+from utils.jobs import enqueue_report
+
+
+BACKFILL_DAYS = int(os.environ.get("BACKFILL_DAYS", 7))
+CRAWL_INTERVAL_HOURS = 6
+PRESUMMARIZE = os.environ.get("PRESUMMARIZE", "false").lower() == "true"
+# A running crawl job older than this belonged to a process that died, it is claimed again
+SCHEDULER_JOB_TIMEOUT = timedelta(minutes=float(os.environ.get("SCHEDULER_JOB_TIMEOUT_MINUTES", 60)))
+
+
+async def get_users():
+    return await database.fetch_all("""
+        SELECT id, preference_keywords, preference_embedding
+        FROM "user"
+        WHERE preference_keywords IS NOT NULL OR preference_embedding IS NOT NULL
+        ORDER BY id
+    """)
+
+
+async def claim_jobs(kind: str, keys: list) -> set:
+    """
+    Claims the keys no process has done or is running, so with several workers
+    each is run once. A failed key is claimed again, and so is a running one
+    older than SCHEDULER_JOB_TIMEOUT, whose process died.
+    """
+    now = datetime.now()
+    rows = await database.fetch_all("""
+        INSERT INTO scheduler_jobs (kind, key, status, updated_at)
+        SELECT :kind, key, 'running', :now FROM unnest(CAST(:keys AS TEXT[])) AS key
+        ON CONFLICT (kind, key) DO UPDATE
+        SET status = EXCLUDED.status, error = NULL, updated_at = EXCLUDED.updated_at
+        WHERE scheduler_jobs.status = 'failed'
+            OR (scheduler_jobs.status = 'running' AND scheduler_jobs.updated_at < :stale_before)
+        RETURNING key
+    """, {"kind": kind, "keys": keys, "now": now, "stale_before": now - SCHEDULER_JOB_TIMEOUT})
+    return {row['key'] for row in rows}
+
+
+async def set_job_status(kind: str, keys: list, status: str, error: str = None):
+    await database.execute_many("""
+        INSERT INTO scheduler_jobs (kind, key, status, error, updated_at)
+        VALUES (:kind, :key, :status, :error, :updated_at)
+        ON CONFLICT (kind, key) DO UPDATE
+        SET status = EXCLUDED.status, error = EXCLUDED.error, updated_at = EXCLUDED.updated_at
+    """, [
+        {"kind": kind, "key": key, "status": status, "error": error, "updated_at": datetime.now()}
+        for key in keys
+    ])
+
+
+async def crawl(users: list, window: str, max_results=50, start_date: datetime = None, end_date: datetime = None, stop_event: asyncio.Event = None):
+    # Users share keywords, so each (keyword, window) is crawled once for everyone
+    keywords = sorted({keyword for user in users for keyword in (user["preference_keywords"] or [])})
+    keys = {f"{keyword}|{window}": keyword for keyword in keywords}
+    claimed = await claim_jobs("crawl", list(keys)) if keys else set()
+    pending = [keyword for key, keyword in keys.items() if key in claimed]
+
+    print(f"Crawling {len(pending)} of {len(keywords)} keywords for {len(users)} users ({window})")
+    if not pending:
+        return
+
+    try:
+        searched = await fetch_and_insert_articles(pending, max_results=max_results, start_date=start_date, end_date=end_date, stop_event=stop_event)
+    except Exception as e:
+        await set_job_status("crawl", list(claimed), "failed", str(e))
+        raise
+
+    # A keyword whose search failed is left to the next crawl of the window, as is everything after a stop
+    if stop_event and stop_event.is_set():
+        searched = set()
+    await set_job_status("crawl", [key for key in claimed if keys[key] in searched], "done")
+    await set_job_status("crawl", [key for key in claimed if keys[key] not in searched], "failed", "Search failed or crawl stopped")
+
+
+async def report_exists(user_id: int, report_date: datetime) -> bool:
+    row = await database.fetch_one(
+        "SELECT id FROM reports WHERE user_id = :user_id AND date >= :start_of_day AND date < :end_of_day LIMIT 1",
+        {"user_id": user_id, "start_of_day": report_date, "end_of_day": report_date + timedelta(days=1)}
+    )
+    return row is not None
+
+
+async def enqueue_reports(users: list, day_offsets, stop_event: asyncio.Event = None):
+    # Goes through the job queue like every other path, so a report a user requested
+    # in the meantime is not generated twice. Workers claim jobs in creation order,
+    # so queueing day by day means every user gets their newest missing report
+    # before anyone gets an older one.
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    queued = 0
+    for day_offset in day_offsets:
+        report_date = today - timedelta(days=day_offset)
+        for user in users:
+            if stop_event and stop_event.is_set():
+                return
+            if user["preference_embedding"] is None or await report_exists(user["id"], report_date):
+                continue
+            await enqueue_report(user["id"], report_date.date())
+            queued += 1
+
+    print(f"Queued {queued} reports for {len(users)} users")
+
+
+def crawl_window() -> str:
+    now = datetime.now()
+    slot = now.replace(hour=now.hour - now.hour % CRAWL_INTERVAL_HOURS, minute=0, second=0, microsecond=0)
+    return f"1d@{slot:%Y-%m-%dT%H}"
+
+
+async def run_crawl(stop_event: asyncio.Event = None):
+    users = await get_users()
+
+    await crawl(users, crawl_window(), stop_event=stop_event)
+
+    # New articles change the clusters' selections, so they are rebuilt after every crawl
+    if SHARED_DIGESTS and not (stop_event and stop_event.is_set()):
+        await build_shared_digests(stop_event=stop_event)
+
+    if PRESUMMARIZE:
+        for user in users:
+            if stop_event and stop_event.is_set():
+                return
+            if user["preference_embedding"] is not None:
+                await presummarize(user)
+
+
+async def backfill(stop_event: asyncio.Event = None):
+    end_date = datetime.now()
+    start_date = end_date - timedelta(days=BACKFILL_DAYS)
+    users = await get_users()
+
+    await crawl(users, f"{start_date:%Y-%m-%d}..{end_date:%Y-%m-%d}", max_results=20, start_date=start_date, end_date=end_date, stop_event=stop_event)
+    if SHARED_DIGESTS:
+        for day_offset in range(BACKFILL_DAYS):
+            if stop_event and stop_event.is_set():
+                return
+            await build_shared_digests(end_date.date() - timedelta(days=day_offset), stop_event=stop_event)
+    await enqueue_reports(users, range(BACKFILL_DAYS), stop_event=stop_event)
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import os
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+
+from utils.metrics import registry, Gauge
+
+
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "google")
+SEARCH_COUNTRY = os.environ.get("SEARCH_COUNTRY", "US")
+SEARCH_CONCURRENCY = int(os.environ.get("SEARCH_CONCURRENCY", 4))
+SEARCH_RATE_PER_SECOND = float(os.environ.get("SEARCH_RATE_PER_SECOND", 2))
+# Results for a rolling period change quickly, results for a closed date window barely at all
+SEARCH_TTL = float(os.environ.get("SEARCH_TTL", 60 * 60))
+SEARCH_HISTORICAL_TTL = float(os.environ.get("SEARCH_HISTORICAL_TTL", 7 * 24 * 60 * 60))
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", 10000))
+
+
+class SearchBackend(ABC):
+    @abstractmethod
+    def search(self, keyword: str, country: str, period: str, max_results: int, start_date: datetime = None, end_date: datetime = None) -> list:
+        ...
+
+
+class GoogleNewsBackend(SearchBackend):
+    def search(self, keyword, country, period, max_results, start_date=None, end_date=None):
+        from newspaper.google_news import GoogleNewsSource
+
+        if start_date and end_date:
+            source = GoogleNewsSource(country=country, period=period, max_results=max_results, start_date=start_date, end_date=end_date)
+        else:
+            source = GoogleNewsSource(country=country, period=period, max_results=max_results)
+
+        source.build(top_news=False, keyword=keyword)
+        return source.article_urls()
+
+
+class FakeSearchBackend(SearchBackend):
+    """Deterministic result URLs on a local host, for tests and benchmarks."""
+
+    def __init__(self, latency: float = 0.0, host: str = "news.test"):
+        self.latency = latency
+        self.host = host
+        self.calls = 0
+
+    def search(self, keyword, country, period, max_results, start_date=None, end_date=None):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        window = f"{start_date:%Y-%m-%d}" if start_date else period
+        slug = hashlib.sha1(f"{keyword}|{country}|{window}".encode('utf-8')).hexdigest()[:12]
+        # The publish date is part of the URL so fake article pages can fall inside the window
+        days = max((end_date - start_date).days, 1) if start_date and end_date else 1
+        first_day = (start_date or datetime.now()).date()
+        return [
+            f"https://{self.host}/{first_day + timedelta(days=index % days):%Y-%m-%d}/{slug}/{index}"
+            for index in range(max_results)
+        ]
+
+
+def get_backend() -> SearchBackend:
+    if SEARCH_BACKEND == "fake":
+        return FakeSearchBackend(latency=float(os.environ.get("FAKE_SEARCH_LATENCY", 0)))
+    return GoogleNewsBackend()
+
+
+class RateLimiter:
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class KeywordSearch:
+    """
+    Caches result URLs per (keyword, country, period, window) with a TTL, limits
+    concurrency and request rate against the backend, and lets concurrent
+    identical lookups share a single in-flight request.
+    """
+
+    def __init__(self, backend: SearchBackend, ttl: float = SEARCH_TTL, historical_ttl: float = SEARCH_HISTORICAL_TTL, concurrency: int = SEARCH_CONCURRENCY, rate: float = SEARCH_RATE_PER_SECOND, max_entries: int = SEARCH_CACHE_MAX_ENTRIES):
+        self.backend = backend
+        self.ttl = ttl
+        self.historical_ttl = historical_ttl
+        self.max_entries = max_entries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._limiter = RateLimiter(rate)
+        self._cache = {}
+        self._in_flight = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def search(self, keyword: str, period: str = "1d", max_results: int = 50, start_date: datetime = None, end_date: datetime = None, country: str = SEARCH_COUNTRY) -> list:
+        # Google News windows have day granularity, so the time of day must not split the cache
+        window = (start_date.date(), end_date.date()) if start_date and end_date else None
+        key = (keyword, country, period, max_results, window)
+
+        cached = self._cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            self.hits += 1
+            return cached[1]
+
+        task = self._in_flight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._search(key, keyword, country, period, max_results, start_date, end_date))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+        return await asyncio.shield(task)
+
+    async def _search(self, key, keyword, country, period, max_results, start_date, end_date):
+        async with self._semaphore:
+            await self._limiter.acquire()
+            urls = await asyncio.to_thread(self.backend.search, keyword, country, period, max_results, start_date, end_date)
+
+        historical = end_date is not None and end_date.date() < datetime.now().date()
+        self._store(key, urls, self.historical_ttl if historical else self.ttl)
+        return urls
+
+    def _store(self, key, urls: list, ttl: float):
+        now = time.monotonic()
+        if len(self._cache) >= self.max_entries:
+            self._cache = {k: v for k, v in self._cache.items() if v[0] > now}
+            while len(self._cache) >= self.max_entries:
+                self._cache.pop(next(iter(self._cache)))
+        self._cache[key] = (now + ttl, urls)
+
+
+keyword_search = KeywordSearch(get_backend())
+registry.register(Gauge(
+    "news_search_cache", "Keyword search cache counters",
+    lambda: {("hits",): keyword_search.hits, ("misses",): keyword_search.misses}, ("counter",)
+))
@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+
+import httpx
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import FileResponse
+
+
+OPENAI_TTS_API_URL = "https://api.openai.com/v1/audio/speech"
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+TTS_MODEL = os.environ.get("TTS_MODEL", "tts-1")
+TTS_VOICE = os.environ.get("TTS_VOICE", "fable")
+TTS_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", ".tts_cache")
+TTS_CACHE_MAX_BYTES = int(os.environ.get("TTS_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+TTS_PRERENDER = os.environ.get("TTS_PRERENDER", "false").lower() == "true"
+
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+def audio_key(text: str, model: str = TTS_MODEL, voice: str = TTS_VOICE) -> str:
+    return hashlib.sha256(f"{model}\0{voice}\0{text}".encode('utf-8')).hexdigest()
+
+
+def report_speech_text(report_text: str) -> str:
+    # Mirrors the text the frontend sends: newlines become <br>, then every tag is stripped
+    return re.sub(r'<[^>]+>', '', report_text.replace('\n', '<br>'))
+
+
+class AudioStore:
+    """Content-addressed audio files on local disk, evicted least recently used first once over `max_bytes`."""
+
+    def __init__(self, directory: str = TTS_CACHE_DIR, max_bytes: int = TTS_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def get(self, key: str):
+        path = self.path(key)
+        try:
+            # The modification time doubles as the LRU timestamp
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def open_temp(self):
+        os.makedirs(self.directory, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=self.directory, suffix=".part", delete=False)
+
+    def commit(self, temp_path: str, key: str):
+        os.replace(temp_path, self.path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".mp3"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+audio_store = AudioStore()
+_client = None
+_prerender_tasks = set()
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=httpx.Timeout(60, connect=10))
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def open_speech(text: str, model: str = TTS_MODEL, voice: str = TTS_VOICE) -> httpx.Response:
+    """Starts the speech request; errors are raised before any audio is sent to the client."""
+    headers = {
+        "Authorization": f"Bearer {OPENAI_API_KEY}",
+        "Content-Type": "application/json",
+    }
+
+    data = {
+        "model": model,
+        "input": text,
+        "voice": voice,
+    }
+
+    client = get_client()
+    try:
+        response = await client.send(client.build_request("POST", OPENAI_TTS_API_URL, json=data, headers=headers), stream=True)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Speech request failed: {e}")
+
+    if response.status_code >= 400:
+        detail = (await response.aread()).decode('utf-8', errors='replace')
+        await response.aclose()
+        raise HTTPException(status_code=502, detail=f"Speech request failed with {response.status_code}: {detail}")
+    return response
+
+
+async def stream_speech(response: httpx.Response, key: str):
+    """Streams an opened speech response while writing it to the audio store; a partial download is discarded."""
+    temp = await asyncio.to_thread(audio_store.open_temp)
+    completed = False
+    try:
+        async for chunk in response.aiter_bytes():
+            await asyncio.to_thread(temp.write, chunk)
+            yield chunk
+        completed = True
+    finally:
+        await response.aclose()
+        await asyncio.to_thread(temp.close)
+        if completed:
+            await asyncio.to_thread(audio_store.commit, temp.name, key)
+        else:
+            await asyncio.to_thread(os.remove, temp.name)
+
+
+async def render(text: str):
+    key = audio_key(text)
+    if await asyncio.to_thread(audio_store.get, key):
+        return
+    try:
+        response = await open_speech(text)
+    except HTTPException as e:
+        print(f"Pre-rendering speech failed: {e.detail}")
+        return
+    async for _ in stream_speech(response, key):
+        pass
+
+
+def prerender_report(report_text: str):
+    if not TTS_PRERENDER:
+        return
+    task = asyncio.ensure_future(render(report_speech_text(report_text)))
+    _prerender_tasks.add(task)
+    task.add_done_callback(_prerender_tasks.discard)
+
+
+def read_range(path: str, start: int, length: int) -> bytes:
+    with open(path, "rb") as file:
+        file.seek(start)
+        return file.read(length)
+
+
+async def audio_response(request: Request, path: str) -> Response:
+    headers = {"Accept-Ranges": "bytes", "Cache-Control": "private, max-age=86400"}
+    range_header = request.headers.get("range")
+    if not range_header:
+        return FileResponse(path, media_type="audio/mpeg", headers=headers)
+
+    size = await asyncio.to_thread(os.path.getsize, path)
+    match = RANGE_PATTERN.match(range_header.strip())
+    if not match or not any(match.groups()):
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+
+    start, end = match.groups()
+    if start:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    else:
+        start, end = max(size - int(end), 0), size - 1
+    if start > end:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+
+    content = await asyncio.to_thread(read_range, path, start, end - start + 1)
+
+    return Response(content, status_code=206, media_type="audio/mpeg", headers=headers | {"Content-Range": f"bytes {start}-{end}/{size}"})
@@ -0,0 +1,65 @@
+import struct
+
+import numpy as np
+
+
+# pgvector's binary wire format: uint16 dimensions, uint16 unused, then big-endian float32 values
+_HEADER = struct.Struct('>HH')
+_WIRE_DTYPE = np.dtype('>f4')
+
+
+def encode_vector(value) -> bytes:
+    vector = np.asarray(value, dtype=_WIRE_DTYPE)
+    return _HEADER.pack(vector.shape[0], 0) + vector.tobytes()
+
+
+def decode_vector(data: bytes):
+    dimensions, _ = _HEADER.unpack_from(data)
+    return np.frombuffer(data, dtype=_WIRE_DTYPE, count=dimensions, offset=_HEADER.size).astype(np.float32)
+
+
+async def register_vector_codec(connection):
+    # Runs for every new pool connection; before initialize_database creates the
+    # extension there is no type to register, and the pool is reopened afterwards
+    if await connection.fetchval("SELECT to_regtype('vector')") is None:
+        return
+    await connection.set_type_codec(
+        'vector',
+        schema='public',
+        encoder=encode_vector,
+        decoder=decode_vector,
+        format='binary',
+    )
+
+
+def vector_matrix(rows, key: str, dimensions: int = None):
+    """Stack the vector column of a query result into one contiguous float32 matrix."""
+    if not rows:
+        return np.empty((0, dimensions or 0), dtype=np.float32)
+    return np.stack([row[key] for row in rows])
+
+
+async def stream_vector_matrix(rows, key: str, limit: int, id_key: str = 'id'):
+    """
+    Collect ids and the vector column from an async row iterator into a
+    preallocated float32 matrix, so rows never pile up in memory. Stops after
+    `limit` rows.
+    """
+    ids = []
+    matrix = None
+    try:
+        async for row in rows:
+            vector = row[key]
+            if matrix is None:
+                matrix = np.empty((limit, len(vector)), dtype=np.float32)
+            matrix[len(ids)] = vector
+            ids.append(row[id_key])
+            if len(ids) == limit:
+                break
+    finally:
+        # Closes the cursor and releases the connection right away when stopping early
+        if hasattr(rows, 'aclose'):
+            await rows.aclose()
+    if matrix is None:
+        return ids, np.empty((0, 0), dtype=np.float32)
+    return ids, matrix[:len(ids)]
@@ -0,0 +1,38 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+import asyncio
+import signal
+from database import database, initialize_database, tables_exist
+from migrations import apply_migrations
+from utils.articles import shutdown_executors
+from utils.jobs import ReportWorkerPool, REPORT_WORKERS
+from utils.tts import close_client as close_tts_client
+
+
+# Runs report jobs without the API, scaled separately from the uvicorn workers:
+#   REPORT_WORKERS=8 python worker.py
+async def main():
+    await database.connect()
+    if not await tables_exist(database):
+        await initialize_database(database)
+    await apply_migrations(database)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    pool = ReportWorkerPool(size=REPORT_WORKERS)
+    pool.start()
+    print(f"Running {REPORT_WORKERS} report workers")
+    await stop_event.wait()
+
+    await pool.stop()
+    shutdown_executors()
+    await close_tts_client()
+    await database.disconnect()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
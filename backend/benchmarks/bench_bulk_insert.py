@@ -0,0 +1,92 @@
+"""
+Article insert throughput: one INSERT per article (the old persist stage)
+against ArticleWriter's COPY + merge. Needs a Postgres with pgvector; the
+synthetic articles are deleted afterwards.
+
+    cd backend
+    DATABASE_URL=postgresql://... python benchmarks/bench_bulk_insert.py [--rows 5000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from database import database, initialize_database, tables_exist, EMBEDDINGS_SIZE
+from migrations import apply_migrations
+from utils.bulk import ArticleWriter
+from utils.partitions import ensure_partitions
+
+
+def synthetic_articles(count: int, prefix: str):
+    rng = np.random.default_rng(0)
+    for index in range(count):
+        yield {
+            "url": f"https://bench.test/{prefix}/{index}",
+            "title": f"Benchmark article {index}",
+            "date": datetime.now(),
+            "content": "lorem ipsum " * 300,
+            "title_embedding": rng.standard_normal(int(EMBEDDINGS_SIZE)).astype(np.float32),
+            "keyword": "benchmark",
+            "minhash": rng.integers(0, 2 ** 31, 128, dtype=np.uint32).tobytes(),
+            "canonical_url": None,
+            "source_name": f"bench-{index % 20}.test",
+            "source_url": f"https://bench-{index % 20}.test",
+            "source_favicon": None,
+        }
+
+
+async def insert_one_by_one(articles):
+    # ArticleWriter creates the partitions it needs, plain INSERTs need them up front
+    await ensure_partitions([article["date"] for article in articles])
+    for article in articles:
+        await database.execute("""
+            INSERT INTO articles (url, title, date, content, title_embedding, keyword, minhash)
+            VALUES (:url, :title, :date, :content, :title_embedding, :keyword, :minhash)
+            ON CONFLICT DO NOTHING;
+        """, {key: article[key] for key in ("url", "title", "date", "content", "title_embedding", "keyword", "minhash")})
+
+
+async def insert_bulk(articles):
+    writer = ArticleWriter()
+    for article in articles:
+        await writer.add(article)
+    await writer.flush()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=5000)
+    args = parser.parse_args()
+
+    await database.connect()
+    if not await tables_exist(database):
+        await initialize_database(database)
+    await apply_migrations(database)
+
+    run = uuid.uuid4().hex[:8]
+    try:
+        for name, insert in (("one by one", insert_one_by_one), ("bulk", insert_bulk)):
+            articles = list(synthetic_articles(args.rows, f"{run}-{name.replace(' ', '-')}"))
+            start = time.perf_counter()
+            await insert(articles)
+            elapsed = time.perf_counter() - start
+            print(f"{name:>10}: {args.rows / elapsed:10.0f} rows/s ({elapsed:.2f}s)")
+    finally:
+        await database.execute("DELETE FROM articles WHERE url LIKE :prefix", {"prefix": f"https://bench.test/{run}-%"})
+        await database.execute("DELETE FROM article_urls WHERE url LIKE :prefix", {"prefix": f"https://bench.test/{run}-%"})
+        await database.execute("DELETE FROM sources WHERE name LIKE 'bench-%.test'")
+        await database.disconnect()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+"""
+Peak Python heap of candidate selection: the old single fetch of full rows
+(content and embedding for every candidate) against the two-phase fetch in
+get_todays_articles, which streams ids and embeddings through a cursor and
+loads the remaining columns for the selected articles only. Needs a Postgres
+with pgvector; the synthetic articles are deleted afterwards.
+
+    cd backend
+    DATABASE_URL=postgresql://... python benchmarks/bench_candidate_memory.py [--rows 1000] [--content-kb 20] [--jobs 4]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from database import database, initialize_database, tables_exist, EMBEDDINGS_SIZE
+from migrations import apply_migrations
+from utils.ai import get_todays_articles, DISTANCE_OPERATORS, VECTOR_DISTANCE
+from utils.bulk import ArticleWriter
+from utils.mmr import mmr
+from utils.vectors import vector_matrix
+
+
+# A day nobody has reports for, so only the synthetic articles are candidates
+DAY_OFFSET = 3650
+
+
+async def full_rows_selection(user, max_articles=8, lambda_param=0.8):
+    target_date = datetime.now().date() - timedelta(days=DAY_OFFSET)
+    start_of_day = datetime.combine(target_date, datetime.min.time())
+    articles = await database.fetch_all(f"""
+        SELECT id, url, title, date, summary, content, title_embedding, keyword
+        FROM articles
+        WHERE date >= :start_of_day AND date < :end_of_day AND duplicate_of IS NULL
+        ORDER BY title_embedding {DISTANCE_OPERATORS[VECTOR_DISTANCE]} :preference_embedding
+        LIMIT 1000
+    """, {"start_of_day": start_of_day, "end_of_day": start_of_day + timedelta(days=1), "preference_embedding": user['preference_embedding']})
+    candidate_ids = [article['id'] for article in articles]
+    selected_ids = mmr(vector_matrix(articles, 'title_embedding'), candidate_ids, user['preference_embedding'], lambda_param, max_articles)
+    return [next(article for article in articles if article['id'] == id) for id in selected_ids]
+
+
+async def two_phase_selection(user, max_articles=8, lambda_param=0.8):
+    return await get_todays_articles(user, day_offset=DAY_OFFSET, max_articles=max_articles, lambda_param=lambda_param)
+
+
+async def measure(select, users):
+    tracemalloc.start()
+    start = time.perf_counter()
+    results = await asyncio.gather(*(select(user) for user in users))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return results, elapsed, peak
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--content-kb', type=int, default=20)
+    parser.add_argument('--jobs', type=int, default=4, help="Concurrent selections, like parallel report jobs")
+    args = parser.parse_args()
+
+    await database.connect()
+    if not await tables_exist(database):
+        await initialize_database(database)
+    await apply_migrations(database)
+
+    run = uuid.uuid4().hex[:8]
+    rng = np.random.default_rng(0)
+    day = datetime.combine(datetime.now().date() - timedelta(days=DAY_OFFSET), datetime.min.time())
+    try:
+        writer = ArticleWriter()
+        for index in range(args.rows):
+            await writer.add({
+                "url": f"https://bench.test/{run}/{index}",
+                "title": f"Benchmark article {index}",
+                "date": day + timedelta(minutes=index % 1440),
+                "content": "x" * (args.content_kb * 1024),
+                "title_embedding": rng.standard_normal(int(EMBEDDINGS_SIZE)).astype(np.float32),
+                "keyword": "benchmark",
+            })
+        await writer.flush()
+
+        # Negative ids have no precomputed candidates, so both paths rank in the database
+        users = [
+            {"id": -index - 1, "preference_embedding": rng.standard_normal(int(EMBEDDINGS_SIZE)).astype(np.float32)}
+            for index in range(args.jobs)
+        ]
+
+        selections = {}
+        for name, select in (("full rows", full_rows_selection), ("two-phase", two_phase_selection)):
+            results, elapsed, peak = await measure(select, users)
+            selections[name] = [[article['id'] for article in result] for result in results]
+            print(f"{name:>10}: peak {peak / 2 ** 20:8.1f} MiB  {elapsed * 1000:8.1f}ms  ({args.jobs} concurrent selections of {args.rows} candidates)")
+
+        print("Same selection:", selections["full rows"] == selections["two-phase"])
+    finally:
+        await database.execute("DELETE FROM articles WHERE url LIKE :prefix", {"prefix": f"https://bench.test/{run}/%"})
+        await database.execute("DELETE FROM article_urls WHERE url LIKE :prefix", {"prefix": f"https://bench.test/{run}/%"})
+        await database.disconnect()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,377 @@
+"""
+End-to-end scenarios with the search, article download, embedding and chat
+models replaced by deterministic local fakes, so ingestion and report
+generation can be measured without network access or API spend:
+
+    crawl     crawl the keywords of all benchmark users
+    backfill  crawl BACKFILL_DAYS days and generate a report per user and day
+    reports   generate today's report for every benchmark user
+    digests   LLM calls for today's reports without and with shared cluster
+              digests (utils/clusters.py), to decide on SHARED_DIGESTS
+    serve     GET report dates and today's report through the reports router
+
+Needs a Postgres with pgvector. Benchmark users, articles and reports are
+deleted before and after the run. Fake latencies are read from FAKE_SEARCH_LATENCY,
+FAKE_DOWNLOAD_LATENCY, FAKE_EMBEDDINGS_LATENCY, FAKE_LLM_LATENCY and
+FAKE_LLM_TOKEN_LATENCY (seconds, defaults below).
+
+    cd backend
+    DATABASE_URL=postgresql://... python benchmarks/bench_end_to_end.py [--keywords 20] [--users 50]
+        [--requests 2000] [--trace-memory] [--output results.json] [--baseline results.json]
+
+With --baseline, exits non-zero if any scenario's throughput dropped or its
+p99 latency grew by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+os.environ.update({
+    "SEARCH_BACKEND": "fake",
+    "DOWNLOAD_BACKEND": "fake",
+    "EMBEDDINGS_BACKEND": "fake",
+    "SUMMARIZATION_MODEL": "fake-summarization",
+    "REPORT_MODEL": "fake-report",
+    "TTS_PRERENDER": "false",
+})
+for name, latency in {
+    "FAKE_SEARCH_LATENCY": 0.2,
+    "FAKE_DOWNLOAD_LATENCY": 0.1,
+    "FAKE_EMBEDDINGS_LATENCY": 0.05,
+    "FAKE_LLM_LATENCY": 0.5,
+    "FAKE_LLM_TOKEN_LATENCY": 0.002,
+}.items():
+    os.environ.setdefault(name, str(latency))
+# The OpenAI embeddings client is still constructed on import, though never called
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+import httpx
+from fastapi import FastAPI, Request
+
+from database import database, initialize_database, tables_exist
+from migrations import apply_migrations
+from routers import reports
+import utils.ai
+from utils.ai import generate_report
+from utils.clusters import build_shared_digests
+from utils.articles import shutdown_executors
+from utils.downloads import downloader
+from utils.embeddings import embed
+from utils.metrics import stage_duration
+from utils.jobs import ReportWorkerPool, REPORT_WORKERS
+from utils.llm_cache import llm_cache
+from utils.scheduler import BACKFILL_DAYS, crawl, enqueue_reports
+from utils.tts import close_client as close_tts_client
+
+
+HOST = "news.test"
+STAGES = ("ingest_fetch", "ingest_parse", "ingest_embed", "ingest_dedup", "ingest_persist", "summarize", "report")
+
+
+def latency_stats(samples: list) -> dict:
+    if not samples:
+        return {"p50_ms": None, "p99_ms": None}
+    p50, p99 = np.percentile(samples, [50, 99])
+    return {"p50_ms": p50 * 1000, "p99_ms": p99 * 1000}
+
+
+def stage_stats() -> dict:
+    stats = {}
+    for stage in STAGES:
+        p50, p99 = stage_duration.quantile(0.5, stage=stage), stage_duration.quantile(0.99, stage=stage)
+        if p50 is not None:
+            stats[stage] = {"p50_ms": p50 * 1000, "p99_ms": p99 * 1000}
+    return stats
+
+
+async def count_articles() -> int:
+    return await database.fetch_val("SELECT COUNT(*) FROM articles WHERE url LIKE :prefix", {"prefix": f"https://{HOST}/%"})
+
+
+async def cleanup():
+    await database.execute('DELETE FROM reports WHERE user_id IN (SELECT id FROM "user" WHERE username LIKE \'bench-%\')')
+    await database.execute("DELETE FROM scheduler_jobs WHERE key LIKE 'bench-%'")
+    await database.execute('DELETE FROM "user" WHERE username LIKE \'bench-%\'')
+    await database.execute("UPDATE articles SET duplicate_of = NULL WHERE url LIKE :prefix", {"prefix": f"https://{HOST}/%"})
+    await database.execute("DELETE FROM articles WHERE url LIKE :prefix", {"prefix": f"https://{HOST}/%"})
+    await database.execute("DELETE FROM article_urls WHERE url LIKE :prefix", {"prefix": f"https://{HOST}/%"})
+    await database.execute("DELETE FROM url_fetch_state WHERE url LIKE :prefix", {"prefix": f"https://{HOST}/%"})
+    await database.execute("DELETE FROM embedding_cache WHERE model = 'fake'")
+    await database.execute("DELETE FROM llm_cache WHERE model LIKE 'fake%'")
+    await database.execute("DELETE FROM llm_savings WHERE model LIKE 'fake%'")
+
+
+async def create_users(count: int, keyword_count: int, keywords_per_user: int = 5) -> list:
+    rng = np.random.default_rng(0)
+    keywords = [f"bench-topic-{index}" for index in range(keyword_count)]
+    users = []
+    for index in range(count):
+        user_keywords = sorted(rng.choice(keywords, size=min(keywords_per_user, keyword_count), replace=False).tolist())
+        preference_text = "Interested in " + ", ".join(user_keywords)
+        values = {
+            "username": f"bench-{index}",
+            "email": f"bench-{index}@{HOST}",
+            "preference_text": preference_text,
+            "preference_keywords": user_keywords,
+            "preference_embedding": await embed(preference_text),
+        }
+        user_id = await database.execute("""
+            INSERT INTO "user" (username, email, preference_text, preference_keywords, preference_embedding)
+            VALUES (:username, :email, :preference_text, :preference_keywords, :preference_embedding)
+            RETURNING id
+        """, values)
+        users.append({"id": user_id, **values})
+    return users
+
+
+async def scenario_crawl(users: list, run: str) -> dict:
+    before = await count_articles()
+    start = time.perf_counter()
+    await crawl(users, f"bench@{run}")
+    elapsed = time.perf_counter() - start
+    inserted = await count_articles() - before
+    return {"elapsed_s": elapsed, "throughput": inserted / elapsed, "unit": "articles/s", "items": inserted}
+
+
+async def scenario_backfill(users: list, run: str) -> dict:
+    end_date = datetime.now()
+    start_date = end_date - timedelta(days=BACKFILL_DAYS)
+    before = await count_articles()
+    start = time.perf_counter()
+    await crawl(users, f"bench@{run}:{start_date:%Y-%m-%d}..{end_date:%Y-%m-%d}", max_results=20, start_date=start_date, end_date=end_date)
+
+    workers = ReportWorkerPool(poll_interval=0.2)
+    workers.start()
+    try:
+        await enqueue_reports(users, range(BACKFILL_DAYS))
+        while await database.fetch_val(
+            "SELECT COUNT(*) FROM report_jobs WHERE user_id = ANY(:user_ids) AND status IN ('queued', 'running')",
+            {"user_ids": [user["id"] for user in users]}
+        ):
+            await asyncio.sleep(0.2)
+    finally:
+        await workers.stop()
+    elapsed = time.perf_counter() - start
+    generated = await database.fetch_val("SELECT COUNT(*) FROM reports WHERE user_id = ANY(:user_ids)", {"user_ids": [user["id"] for user in users]})
+    return {
+        "elapsed_s": elapsed,
+        "throughput": generated / elapsed,
+        "unit": "reports/s",
+        "items": generated,
+        "articles": await count_articles() - before,
+    }
+
+
+async def scenario_reports(users: list) -> dict:
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    await database.execute("DELETE FROM reports WHERE user_id = ANY(:user_ids) AND date >= :today", {
+        "user_ids": [user["id"] for user in users], "today": today
+    })
+    # Backfill already generated these, measure generation rather than cache hits
+    await database.execute("DELETE FROM llm_cache WHERE kind = 'report' AND model LIKE 'fake%'")
+
+    semaphore = asyncio.Semaphore(REPORT_WORKERS)
+    samples = []
+
+    async def run(user):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await generate_report(user)
+            except Exception as e:
+                print(f"Report for user {user['id']} failed: {e}")
+                return
+            samples.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(user) for user in users))
+    elapsed = time.perf_counter() - start
+    return {"elapsed_s": elapsed, "throughput": len(samples) / elapsed, "unit": "reports/s", "items": len(samples), **latency_stats(samples)}
+
+
+async def scenario_digests(users: list) -> dict:
+    today = datetime.now().date()
+    user_ids = [user["id"] for user in users]
+    calls = {}
+    configured = utils.ai.SHARED_DIGESTS
+    for shared in (False, True):
+        # Both runs start without any summaries, cached outputs or clusters for today
+        await database.execute("DELETE FROM reports WHERE user_id = ANY(:user_ids) AND date >= :today", {"user_ids": user_ids, "today": today})
+        await database.execute("DELETE FROM llm_cache WHERE model LIKE 'fake%'")
+        await database.execute("UPDATE articles SET summary = NULL WHERE url LIKE :prefix", {"prefix": f"https://{HOST}/%"})
+        await database.execute("""
+            DELETE FROM cluster_selections
+            WHERE day = :today AND cluster IN (SELECT cluster FROM user_clusters WHERE day = :today AND user_id = ANY(:user_ids))
+        """, {"today": today, "user_ids": user_ids})
+        await database.execute("DELETE FROM user_clusters WHERE day = :today AND user_id = ANY(:user_ids)", {"today": today, "user_ids": user_ids})
+
+        misses = dict(llm_cache.misses)
+        start = time.perf_counter()
+        # Reports only take their cluster's selection with shared digests on
+        utils.ai.SHARED_DIGESTS = shared
+        if shared:
+            await build_shared_digests(today)
+        semaphore = asyncio.Semaphore(REPORT_WORKERS)
+
+        async def run(user):
+            async with semaphore:
+                try:
+                    await generate_report(user)
+                except Exception as e:
+                    print(f"Report for user {user['id']} failed: {e}")
+
+        await asyncio.gather(*(run(user) for user in users))
+        elapsed = time.perf_counter() - start
+        # Every cache miss is one LLM call
+        calls[shared] = {kind: llm_cache.misses.get(kind, 0) - misses.get(kind, 0) for kind in ("summarize", "report")}
+    utils.ai.SHARED_DIGESTS = configured
+
+    matched = await database.fetch_val(
+        "SELECT COUNT(*) FROM user_clusters WHERE day = :today AND user_id = ANY(:user_ids) AND matched",
+        {"today": today, "user_ids": user_ids}
+    )
+    print(f"  digests: {matched} of {len(users)} users took their cluster's selection; LLM calls "
+          f"{sum(calls[False].values())} without, {sum(calls[True].values())} with shared digests "
+          f"(summarize {calls[False]['summarize']} -> {calls[True]['summarize']}, report {calls[False]['report']} -> {calls[True]['report']})")
+    return {
+        "elapsed_s": elapsed,
+        "throughput": len(users) / elapsed,
+        "unit": "reports/s",
+        "items": len(users),
+        "matched": matched,
+        "llm_calls_without": calls[False],
+        "llm_calls_with": calls[True],
+    }
+
+
+async def scenario_serve(users: list, requests: int, concurrency: int = 32) -> dict:
+    users_by_id = {str(user["id"]): user for user in users}
+
+    async def bench_user(request: Request):
+        return users_by_id[request.headers["x-bench-user"]]
+
+    app = FastAPI()
+    app.include_router(reports.router)
+    app.dependency_overrides[reports.user] = bench_user
+
+    today = f"{datetime.now():%Y-%m-%d}"
+    paths = [f"/reports/{today}", "/reports/dates"]
+    semaphore = asyncio.Semaphore(concurrency)
+    samples = []
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        async def get(index: int):
+            user = users[index % len(users)]
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.get(paths[index % len(paths)], headers={"x-bench-user": str(user["id"])})
+                samples.append(time.perf_counter() - start)
+            if response.status_code >= 400 and response.status_code != 404:
+                print(f"GET {paths[index % len(paths)]} returned {response.status_code}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(get(index) for index in range(requests)))
+        elapsed = time.perf_counter() - start
+
+    return {"elapsed_s": elapsed, "throughput": requests / elapsed, "unit": "requests/s", "items": requests, **latency_stats(samples)}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        if result["throughput"] < previous["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {result['throughput']:.2f} < {previous['throughput']:.2f} {result['unit']}")
+        if result.get("p99_ms") and previous.get("p99_ms") and result["p99_ms"] > previous["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {result['p99_ms']:.1f}ms > {previous['p99_ms']:.1f}ms")
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keywords', type=int, default=20)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--scenarios', default="crawl,backfill,reports,serve")
+    parser.add_argument('--trace-memory', action='store_true', help="Track peak Python heap per scenario (slower)")
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    await database.connect()
+    if not await tables_exist(database):
+        await initialize_database(database)
+    await apply_migrations(database)
+
+    run = f"{time.time():.0f}"
+    scenarios = {
+        "crawl": lambda users: scenario_crawl(users, run),
+        "backfill": lambda users: scenario_backfill(users, run),
+        "reports": scenario_reports,
+        "digests": scenario_digests,
+        "serve": lambda users: scenario_serve(users, args.requests),
+    }
+
+    results = {}
+    users = []
+    try:
+        await cleanup()
+        users = await create_users(args.users, args.keywords)
+        if args.trace_memory:
+            tracemalloc.start()
+
+        for name in args.scenarios.split(","):
+            if args.trace_memory:
+                tracemalloc.reset_peak()
+            result = await scenarios[name](users)
+            if args.trace_memory:
+                result["peak_heap_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            # ru_maxrss is in KiB on Linux; it is the peak of the whole run so far
+            result["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            results[name] = result
+
+            latency = f"p50 {result['p50_ms']:8.1f}ms  p99 {result['p99_ms']:8.1f}ms" if result.get("p50_ms") is not None else " " * 31
+            memory = f"  heap {result['peak_heap_mb']:7.1f} MiB" if "peak_heap_mb" in result else ""
+            print(f"{name:>9}: {result['throughput']:9.2f} {result['unit']:<11} {latency}  rss {result['max_rss_mb']:7.1f} MiB{memory}  ({result['items']} in {result['elapsed_s']:.1f}s)")
+
+        results["stages"] = stage_stats()
+        for stage, stats in results["stages"].items():
+            print(f"{stage:>15}: p50 {stats['p50_ms']:8.1f}ms  p99 {stats['p99_ms']:8.1f}ms")
+    finally:
+        await cleanup()
+        shutdown_executors()
+        await downloader.close()
+        await close_tts_client()
+        await database.disconnect()
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare({name: result for name, result in results.items() if name != "stages"}, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
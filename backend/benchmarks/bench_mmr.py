@@ -0,0 +1,89 @@
+"""
+Compares the original pure-Python MMR with the vectorized one in utils.mmr.
+
+    cd backend
+    python benchmarks/bench_mmr.py [--full]
+
+The reference implementation is O(k * n^2), so by default it is only run up to
+n = 1000. Pass --full to include n = 10000 as well (this takes a long time).
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from utils.mmr import mmr, cosine_similarity
+
+
+def mmr_reference(candidate_embeddings, candidate_ids, query_embedding, lambda_param, k):
+    unselected = set(candidate_ids)
+    selected = []
+
+    while len(selected) < k and unselected:
+        relevance_scores = {
+            doc_id: cosine_similarity(query_embedding, candidate_embeddings[candidate_ids.index(doc_id)])
+            for doc_id in unselected
+        }
+
+        if not selected:
+            best_doc = max(relevance_scores.items(), key=lambda x: x[1])[0]
+        else:
+            def mmr_score(doc_id):
+                relevance = relevance_scores[doc_id]
+                diversity = min(
+                    1 - cosine_similarity(
+                        candidate_embeddings[candidate_ids.index(doc_id)],
+                        candidate_embeddings[candidate_ids.index(selected_id)]
+                    )
+                    for selected_id in selected
+                )
+                return lambda_param * relevance + (1 - lambda_param) * diversity
+
+            best_doc = max(unselected, key=mmr_score)
+
+        selected.append(best_doc)
+        unselected.remove(best_doc)
+
+    return selected
+
+
+def timed(fn, *args, repeat=1):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--full', action='store_true', help='also run the reference implementation for n = 10000')
+    parser.add_argument('--dimensions', type=int, default=1024)
+    parser.add_argument('--lambda-param', type=float, default=0.8)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'n':>6} {'k':>4} {'reference (s)':>14} {'vectorized (s)':>15} {'speedup':>8}  same")
+
+    for n in (100, 1000, 10000):
+        embeddings = rng.standard_normal((n, args.dimensions)).astype(np.float32)
+        query = rng.standard_normal(args.dimensions).astype(np.float32)
+        ids = list(range(n))
+
+        for k in (8, 50):
+            vectorized_time, vectorized = timed(mmr, embeddings, ids, query, args.lambda_param, k, repeat=5)
+
+            if n <= 1000 or args.full:
+                reference_time, reference = timed(mmr_reference, list(embeddings), ids, query, args.lambda_param, k)
+                print(f"{n:>6} {k:>4} {reference_time:>14.4f} {vectorized_time:>15.4f} {reference_time / vectorized_time:>7.0f}x  {reference == vectorized}")
+            else:
+                print(f"{n:>6} {k:>4} {'skipped':>14} {vectorized_time:>15.4f} {'-':>8}  -")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Decode time for a 1000-row candidate query result: pgvector's text format parsed
+with json.loads (the old path) against the binary codec in utils.vectors.
+
+    cd backend
+    python benchmarks/bench_vectors.py [--rows 1000] [--dimensions 1024]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from utils.vectors import encode_vector, decode_vector
+
+
+def best_of(fn, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--dimensions', type=int, default=1024)
+    args = parser.parse_args()
+
+    vectors = np.random.default_rng(0).standard_normal((args.rows, args.dimensions)).astype(np.float32)
+    text_rows = ['[' + ','.join(repr(float(x)) for x in vector) + ']' for vector in vectors]
+    binary_rows = [encode_vector(vector) for vector in vectors]
+
+    def decode_json():
+        return np.stack([np.array(json.loads(row), dtype=np.float32) for row in text_rows])
+
+    def decode_binary():
+        return np.stack([decode_vector(row) for row in binary_rows])
+
+    assert np.array_equal(decode_json(), decode_binary())
+
+    json_time = best_of(decode_json)
+    binary_time = best_of(decode_binary)
+
+    print(f"{args.rows} rows x {args.dimensions} dimensions")
+    print(f"  text payload:   {sum(len(row) for row in text_rows) / args.rows / 1024:8.1f} KiB/row")
+    print(f"  binary payload: {sum(len(row) for row in binary_rows) / args.rows / 1024:8.1f} KiB/row")
+    print(f"  json decode:    {json_time * 1000:8.2f} ms")
+    print(f"  binary decode:  {binary_time * 1000:8.2f} ms ({json_time / binary_time:.0f}x)")
+
+
+if __name__ == '__main__':
+    main()
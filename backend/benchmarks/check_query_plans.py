@@ -0,0 +1,100 @@
+"""
+EXPLAIN-based regression check that the hot queries can use their indexes.
+
+    cd backend
+    DATABASE_URL=postgresql://... python benchmarks/check_query_plans.py
+
+Sequential scans are disabled for the check so the result does not depend on
+how much data the database holds. Exits non-zero if a query stops using its
+index.
+"""
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from database import database, initialize_database, tables_exist, EMBEDDINGS_SIZE
+from migrations import apply_migrations
+from dal import connection, REPORT_FOR_DAY
+from utils.partitions import ensure_partitions
+from utils.ai import candidate_query, CANDIDATE_LIMIT
+
+
+def index_names(plan: dict) -> set:
+    names = {plan['Index Name']} if 'Index Name' in plan else set()
+    for child in plan.get('Plans', []):
+        names |= index_names(child)
+    return names
+
+
+async def explain(query: str, args: tuple) -> set:
+    async with connection() as raw_connection:
+        async with raw_connection.transaction():
+            await raw_connection.execute("SET LOCAL enable_seqscan = off;")
+            plan = await raw_connection.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args)
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return index_names(plan[0]['Plan'])
+
+
+async def partition_indexes(names: set) -> set:
+    async with connection() as raw_connection:
+        rows = await raw_connection.fetch("""
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = ANY($1::TEXT[])
+        """, list(names))
+    return {row['relname'] for row in rows}
+
+
+async def main():
+    await database.connect()
+    if not await tables_exist(database):
+        await initialize_database(database)
+    await apply_migrations(database)
+
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    embedding = np.random.default_rng(0).standard_normal(int(EMBEDDINGS_SIZE)).astype(np.float32)
+
+    checks = [
+        (
+            "candidate search",
+            candidate_query(),
+            (today, today + timedelta(days=1), embedding, CANDIDATE_LIMIT),
+            {"articles_date_idx"},
+        ),
+        (
+            "report lookup",
+            REPORT_FOR_DAY,
+            (1, today, today + timedelta(days=1)),
+            {"reports_user_id_date_idx"},
+        ),
+    ]
+
+    # Articles are partitioned, so plans use the per-partition copies of its indexes
+    await ensure_partitions([today])
+
+    failed = False
+    for name, query, args, expected in checks:
+        expected = expected | await partition_indexes(expected)
+        used = await explain(query, args)
+        ok = bool(used & expected)
+        failed |= not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {name}: uses {sorted(used) or 'no index'}, expected one of {sorted(expected)}")
+
+    await database.disconnect()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,163 @@
+"""
+Load test of the hot queries: the user lookup, report lookup, report and
+selected article batch lookups, candidate search and URL existence check, each
+run through `databases` with named parameters and through the asyncpg data
+access layer in dal.py. Prints a latency histogram and percentiles per query.
+Needs a Postgres with pgvector; the synthetic user, report and articles are
+deleted afterwards.
+
+    cd backend
+    DATABASE_URL=postgresql://... python benchmarks/load_test_queries.py [--requests 2000] [--concurrency 32]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+import dal
+from database import database, initialize_database, tables_exist, EMBEDDINGS_SIZE, DB_POOL_MAX_SIZE
+from migrations import apply_migrations
+from utils.ai import candidate_query, CANDIDATE_LIMIT, DISTANCE_OPERATORS, VECTOR_DISTANCE
+from utils.bulk import ArticleWriter
+from utils.metrics import DEFAULT_BUCKETS
+
+
+def text_queries(user_id, article_ids, urls, today, embedding):
+    """The same queries as sent before dal.py, through `databases`."""
+    window = {"start_of_day": today, "end_of_day": today + timedelta(days=1)}
+    return {
+        "user": lambda: database.fetch_one('SELECT * FROM "user" WHERE id = :user_id', {"user_id": user_id}),
+        "report_for_day": lambda: database.fetch_one("""
+            SELECT id, created_at, text, article_ids, date FROM reports
+            WHERE user_id = :user_id AND date >= :start_of_day AND date < :end_of_day
+            ORDER BY created_at DESC LIMIT 1
+        """, {"user_id": user_id, **window}),
+        "report_articles": lambda: database.fetch_all("""
+            SELECT articles.id, articles.url, articles.title, articles.date, articles.summary,
+                sources.id AS source_id, sources.name AS source_name, sources.url AS source_url, sources.favicon AS source_favicon
+            FROM articles LEFT JOIN sources ON sources.id = articles.source_id
+            WHERE articles.id = ANY(:article_ids)
+        """, {"article_ids": article_ids}),
+        "selected_articles": lambda: database.fetch_all(
+            "SELECT id, url, title, date, summary, content, keyword FROM articles WHERE id = ANY(:article_ids)",
+            {"article_ids": article_ids}
+        ),
+        "candidate_search": lambda: database.fetch_all(f"""
+            SELECT id, title_embedding FROM articles
+            WHERE date >= :start_of_day AND date < :end_of_day AND duplicate_of IS NULL
+            ORDER BY title_embedding {DISTANCE_OPERATORS[VECTOR_DISTANCE]} :embedding
+            LIMIT {CANDIDATE_LIMIT}
+        """, {**window, "embedding": embedding}),
+        "existing_urls": lambda: database.fetch_all("SELECT url FROM articles WHERE url = ANY(:urls)", {"urls": urls}),
+    }
+
+
+def dal_queries(user_id, article_ids, urls, today, embedding):
+    async def candidate_search():
+        return [row async for row in dal.iterate("candidate_search", candidate_query(), today, today + timedelta(days=1), embedding, CANDIDATE_LIMIT)]
+
+    return {
+        "user": lambda: dal.get_user(user_id),
+        "report_for_day": lambda: dal.report_for_day(user_id, today, today + timedelta(days=1)),
+        "report_articles": lambda: dal.report_articles(article_ids),
+        "selected_articles": lambda: dal.selected_articles(article_ids),
+        "candidate_search": candidate_search,
+        "existing_urls": lambda: dal.existing_urls(urls),
+    }
+
+
+async def load(queries: dict, requests: int, concurrency: int) -> dict:
+    names = list(queries)
+    samples = {name: [] for name in names}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(index: int):
+        name = names[index % len(names)]
+        async with semaphore:
+            start = time.perf_counter()
+            await queries[name]()
+            samples[name].append(time.perf_counter() - start)
+
+    await asyncio.gather(*(run(index) for index in range(requests)))
+    return samples
+
+
+def print_histogram(name: str, samples: list):
+    counts = np.histogram(samples, bins=(0,) + DEFAULT_BUCKETS + (float("inf"),))[0]
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1000
+    print(f"  {name:<18} p50 {p50:7.2f}ms  p95 {p95:7.2f}ms  p99 {p99:7.2f}ms")
+    width = max(counts)
+    for bound, count in zip(DEFAULT_BUCKETS + (float("inf"),), counts):
+        if count:
+            print(f"    <= {bound * 1000:>8.0f}ms {'#' * max(1, round(40 * count / width)):<40} {count}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=DB_POOL_MAX_SIZE)
+    parser.add_argument('--articles', type=int, default=500)
+    args = parser.parse_args()
+
+    await database.connect()
+    if not await tables_exist(database):
+        await initialize_database(database)
+    await apply_migrations(database)
+
+    run = uuid.uuid4().hex[:8]
+    rng = np.random.default_rng(0)
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    user_id = None
+    try:
+        writer = ArticleWriter()
+        for index in range(args.articles):
+            await writer.add({
+                "url": f"https://bench.test/{run}/{index}",
+                "title": f"Benchmark article {index}",
+                "date": today + timedelta(minutes=index % 1440),
+                "content": "lorem ipsum " * 500,
+                "title_embedding": rng.standard_normal(int(EMBEDDINGS_SIZE)).astype(np.float32),
+                "keyword": "benchmark",
+            })
+        await writer.flush()
+        article_ids = [row["id"] for row in writer.inserted[:8]]
+        urls = [row["url"] for row in writer.inserted[:50]] + [f"https://bench.test/{run}/missing/{index}" for index in range(50)]
+
+        embedding = rng.standard_normal(int(EMBEDDINGS_SIZE)).astype(np.float32)
+        user_id = await database.execute("""
+            INSERT INTO "user" (username, email, preference_text, preference_keywords, preference_embedding)
+            VALUES (:username, :email, 'benchmark', ARRAY['benchmark'], :embedding)
+            RETURNING id
+        """, {"username": f"bench-{run}", "email": f"bench-{run}@bench.test", "embedding": embedding})
+        await database.execute(
+            "INSERT INTO reports (user_id, text, article_ids, date) VALUES (:user_id, 'benchmark', :article_ids, :date)",
+            {"user_id": user_id, "article_ids": article_ids, "date": today}
+        )
+
+        for name, queries in (("databases", text_queries), ("dal", dal_queries)):
+            start = time.perf_counter()
+            samples = await load(queries(user_id, article_ids, urls, today, embedding), args.requests, args.concurrency)
+            elapsed = time.perf_counter() - start
+            print(f"{name}: {args.requests / elapsed:.0f} queries/s at concurrency {args.concurrency}")
+            for query, query_samples in samples.items():
+                print_histogram(query, query_samples)
+    finally:
+        if user_id is not None:
+            await database.execute('DELETE FROM "user" WHERE id = :user_id', {"user_id": user_id})
+        await database.execute("DELETE FROM articles WHERE url LIKE :prefix", {"prefix": f"https://bench.test/{run}/%"})
+        await database.execute("DELETE FROM article_urls WHERE url LIKE :prefix", {"prefix": f"https://bench.test/{run}/%"})
+        await database.disconnect()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())